@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import time
+
+import dialog_cache
+import drafts
+import message_handler
+import message_store
+from message_store import current_account, is_channel_id
+
+# Telethon session names of the monitored accounts; the first one is the
+# primary account, whose chats keep their Telegram ids in the store
+ACCOUNTS = ["my_session"]
+
+# Our own user id per session name, learned from Telegram when a client
+# starts and saved so commands that stay offline know it too
+SELF_IDS = {}
+SELF_IDS_NAME = "accounts.json"
+
+def account_index(name):
+    """Returns the index of the account with session ``name``; raises ValueError."""
+    try:
+        return ACCOUNTS.index(name)
+    except ValueError:
+        raise ValueError(f"Unknown account {name!r}; configured: {', '.join(ACCOUNTS)}") from None
+
+def _self_ids_path():
+    return os.path.join(message_store.DB_DIR, SELF_IDS_NAME)
+
+def remember_self(user_id, account=None):
+    """Records our user id for the current account, or ``account``."""
+    name = ACCOUNTS[current_account.get() if account is None else account]
+    if SELF_IDS.get(name) == user_id:
+        return
+    SELF_IDS[name] = user_id
+    saved = _load_self_ids()
+    saved[name] = user_id
+    os.makedirs(message_store.DB_DIR, exist_ok=True)
+    with open(_self_ids_path() + ".tmp", "w") as f:
+        json.dump(saved, f)
+    os.replace(_self_ids_path() + ".tmp", _self_ids_path())
+
+def _load_self_ids():
+    try:
+        with open(_self_ids_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def self_id(account=None):
+    """Returns our user id for the current account, or ``account``; None if never seen."""
+    name = ACCOUNTS[current_account.get() if account is None else account]
+    if name not in SELF_IDS:
+        saved = _load_self_ids().get(name)
+        if saved is None:
+            return None
+        SELF_IDS[name] = saved
+    return SELF_IDS[name]
+
+def assign_shared(snapshots):
+    """Splits the dialogs of every account so each chat is synced once.
+
+    Private chats and small groups belong to the account that sees them.
+    Channels and supergroups seen by several accounts go to whichever of
+    those accounts has the fewest dialogs so far, so the accounts finish
+    at about the same time. Returns one list of dialogs per account.
+    """
+    assigned = [[dialog for dialog in snapshot if not is_channel_id(dialog.id)] for snapshot in snapshots]
+    seen_by = {}
+    for index, snapshot in enumerate(snapshots):
+        for dialog in snapshot:
+            if is_channel_id(dialog.id):
+                seen_by.setdefault(dialog.id, []).append((index, dialog))
+    for candidates in seen_by.values():
+        index, dialog = min(candidates, key=lambda candidate: len(assigned[candidate[0]]))
+        assigned[index].append(dialog)
+    return assigned
+
+async def fetch_all(get_client):
+    """Syncs every account at once, each with its own client and rate limit.
+
+    ``get_client`` returns the started client of the current account.
+    Once every account is synced, reply drafts are precomputed for the
+    chats each one updated. Returns the totals of each account.
+    """
+    started = time.monotonic()
+
+    async def list_dialogs(index):
+        current_account.set(index)
+        return await dialog_cache.get_snapshot(await get_client())
+
+    snapshots = await asyncio.gather(*(list_dialogs(index) for index in range(len(ACCOUNTS))))
+    assigned = assign_shared(snapshots)
+    shared = sum(len(snapshot) for snapshot in snapshots) - sum(len(dialogs) for dialogs in assigned)
+    if shared:
+        print(f"{shared} chats are shared between accounts and synced once")
+
+    async def sync(index):
+        # Runs in its own task, so the account only applies here
+        current_account.set(index)
+        print(f"Syncing {len(assigned[index])} chats of {ACCOUNTS[index]}")
+        return await message_handler.fetch_messages(await get_client(), dialogs=assigned[index])
+
+    results = await asyncio.gather(*(sync(index) for index in range(len(ACCOUNTS))), return_exceptions=True)
+    for name, result in zip(ACCOUNTS, results):
+        if isinstance(result, BaseException):
+            print(f"Failed to sync {name}: {result}")
+        else:
+            print(f"{name}: {result['messages']} messages from {result['chats']} chats in {result['elapsed']:.1f}s")
+    print(f"Synced {len(ACCOUNTS)} accounts in {time.monotonic() - started:.1f}s")
+
+    async def precompute(index, result):
+        # Drafts are read and written under the account's own chat ids
+        current_account.set(index)
+        await drafts.precompute(result["updated_chats"])
+
+    await asyncio.gather(*(precompute(index, result) for index, result in enumerate(results)
+                           if not isinstance(result, BaseException)))
+    return results
@@ -0,0 +1,188 @@
+import time
+
+import dialog_cache
+import message_handler
+import metrics
+import senders
+from message_store import (
+    MessageWriter,
+    count_messages,
+    get_backfill_state,
+    get_sync_info,
+    has_retention_policy,
+    set_retention_policy,
+    update_backfill_state,
+    update_sync_info,
+)
+
+DEBUG = True
+
+# Messages requested per page; each page is stored in one transaction and
+# checkpointed. Telethon fetches history 100 messages per request.
+BACKFILL_PAGE_SIZE = 1000
+
+def format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+async def _fetch_page(client, dialog, limiter, offset_id, offset_date, page_size):
+    """Returns one page of history older than ``offset_id``, newest first, and the chat's total."""
+    from telethon.errors import FloodWaitError
+
+    for attempt in range(message_handler.FLOOD_WAIT_RETRIES + 1):
+        try:
+            await limiter.acquire()
+            page = []
+            with metrics.timer("backfill_page_seconds"):
+                messages = client.iter_messages(dialog.entity, limit=page_size,
+                                                offset_id=offset_id, offset_date=offset_date)
+                async for message in messages:
+                    page.append(message)
+                    if len(page) % 100 == 0:
+                        await limiter.acquire()
+            # Telethon learns the chat's message count from the first request
+            return page, getattr(messages, "total", None)
+        except FloodWaitError as e:
+            if attempt == message_handler.FLOOD_WAIT_RETRIES:
+                raise
+            print(f"FloodWait of {e.seconds}s while backfilling chat {dialog.id}, backing off")
+            metrics.inc("telegram_flood_waits_total")
+            metrics.inc("telegram_flood_wait_seconds_total", e.seconds)
+            limiter.pause(e.seconds)
+
+async def backfill_chat(client, dialog, limiter, since=None, until=None, page_size=None):
+    """Stores a chat's history page by page, going backward in time.
+
+    Resumes below the oldest message checkpointed by an earlier run.
+    Messages older than ``since`` stop the walk and messages from ``until``
+    on are skipped. A run with ``until`` starts there instead of at the
+    newest message or the checkpoint and leaves what it skips unstored, so
+    it neither resumes nor moves the checkpoint; a later run without it
+    still covers the whole chat. Returns the number of messages fetched
+    and stored, and whether the start of the chat was reached.
+    """
+    page_size = page_size or BACKFILL_PAGE_SIZE
+    chat_id = dialog.id
+    result = {"messages": 0, "written": 0, "done": False}
+
+    with MessageWriter(chat_id, batch_size=page_size) as writer:
+        oldest_id, done = get_backfill_state(chat_id, conn=writer.conn)
+        if done:
+            if DEBUG: print(f"{dialog.title}: already backfilled to the first message")
+            result["done"] = True
+            return result
+
+        # Checkpoints only cover history with no gap up to the newest message
+        checkpoint = until is None
+        offset_id = (oldest_id or 0) if checkpoint else 0
+        offset_date = until
+        known = count_messages(chat_id, conn=writer.conn)
+        started = time.monotonic()
+
+        while True:
+            page, total = await _fetch_page(client, dialog, limiter, offset_id, offset_date, page_size)
+            if not page:
+                result["done"] = True
+                if checkpoint:
+                    # History ended on a page boundary
+                    update_backfill_state(chat_id, offset_id or None, done=True, conn=writer.conn)
+                break
+
+            sender_batch = senders.SenderBatch()
+            covered_id = offset_id
+            reached_since = False
+            fetched = 0
+            for message in page:
+                if since is not None and message.date < since:
+                    reached_since = True
+                    break
+                covered_id = message.id
+                fetched += 1
+                if until is not None and message.date >= until:
+                    continue
+                if message.text:
+                    writer.add(message.id, message.date, message.sender_id, message.text)
+                    sender_batch.add(message)
+            # One transaction per page
+            writer.flush()
+            await senders.resolve(client, chat_id, sender_batch, conn=writer.conn, limiter=limiter)
+
+            if offset_id == 0 and checkpoint and page[0].id > get_sync_info(chat_id, conn=writer.conn):
+                # Everything up to the newest message is stored now, so
+                # fetch only needs what arrives after it
+                update_sync_info(chat_id, page[0].id, conn=writer.conn)
+
+            result["messages"] += fetched
+            result["done"] = not reached_since and len(page) < page_size
+            if checkpoint and covered_id:
+                update_backfill_state(chat_id, covered_id, done=result["done"], conn=writer.conn)
+            metrics.inc("backfill_messages_total", fetched)
+
+            elapsed = time.monotonic() - started
+            rate = result["messages"] / elapsed if elapsed > 0 else 0.0
+            progress = f"{dialog.title}: {result['messages']} messages, {rate:.0f} msg/s"
+            if total:
+                # Messages stored before this run approximate where it resumed
+                remaining = max(0, total - known - result["messages"])
+                progress += f", {remaining} left, ETA {format_eta(remaining / rate if rate else None)}"
+            print(progress)
+
+            if reached_since or result["done"]:
+                break
+            offset_id = page[-1].id
+            offset_date = None
+
+    result["written"] = writer.written
+    return result
+
+async def backfill(client, chat_ids=None, since=None, until=None, rate=None, page_size=None):
+    """Backfills the history of every chat, or of ``chat_ids``, one chat at a time.
+
+    ``since`` and ``until`` are timezone-aware datetimes limiting the
+    messages stored. Interrupted runs resume from their checkpoints.
+    Backfilled chats are switched to keep-all retention unless they have a
+    policy of their own, so maintenance does not delete what was imported.
+    Returns the run totals.
+    """
+    totals = {"chats": 0, "failed": 0, "messages": 0, "written": 0, "elapsed": 0.0}
+    started = time.monotonic()
+    snapshot = await dialog_cache.get_snapshot(client)
+    dialogs = [dialog for dialog in snapshot if chat_ids is None or dialog.id in chat_ids]
+    if chat_ids is not None:
+        missing = set(chat_ids) - {dialog.id for dialog in dialogs}
+        for chat_id in sorted(missing):
+            print(f"Chat {chat_id} is not in the dialog list; skipping")
+
+    limiter = message_handler._new_limiter(rate)
+    for n, dialog in enumerate(dialogs, 1):
+        print(f"Backfilling '{dialog.title}' ({n}/{len(dialogs)})")
+        try:
+            result = await backfill_chat(client, dialog, limiter, since=since, until=until, page_size=page_size)
+        except Exception as e:
+            # Already stored pages stay checkpointed; the next run resumes
+            print(f"Failed to backfill chat {dialog.id}: {e}")
+            totals["failed"] += 1
+            continue
+        totals["chats"] += 1
+        totals["messages"] += result["messages"]
+        totals["written"] += result["written"]
+        if result["written"] and not has_retention_policy(dialog.id):
+            set_retention_policy(dialog.id, keep_all=True)
+            if DEBUG: print(f"Retention for '{dialog.title}' set to keep-all")
+
+    totals["elapsed"] = time.monotonic() - started
+    return totals
+
+def format_report(totals):
+    rate = totals["messages"] / totals["elapsed"] if totals["elapsed"] > 0 else 0.0
+    report = (f"Backfilled {totals['chats']} chats: fetched {totals['messages']} messages, "
+              f"stored {totals['written']} new, in {totals['elapsed']:.1f}s ({rate:.0f} msg/s)")
+    if totals["failed"]:
+        report += f"; {totals['failed']} chats failed"
+    return report
@@ -0,0 +1,61 @@
+"""Compares two benchmark result files from bench.run.
+
+    python -m bench.compare baseline.json candidate.json --threshold 0.1
+
+Exits with status 1 when any metric got worse by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+# Metrics where a larger number is an improvement; everything else timed
+# or sized is better smaller
+HIGHER_IS_BETTER = ("per_second",)
+LOWER_IS_BETTER = ("elapsed", "first_token", "total_time", "peak_rss")
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)
+    if isinstance(results, dict):
+        results = [results]
+    return {result["scenario"]: result["metrics"] for result in results}
+
+def direction(metric):
+    """Returns 1 if larger is better, -1 if smaller is better, else 0."""
+    if any(part in metric for part in HIGHER_IS_BETTER):
+        return 1
+    if any(part in metric for part in LOWER_IS_BETTER):
+        return -1
+    return 0
+
+def compare(baseline, candidate, threshold):
+    """Prints every shared metric and returns the regressions found."""
+    regressions = []
+    for scenario in baseline.keys() & candidate.keys():
+        print(f"{scenario}:")
+        for metric, old in baseline[scenario].items():
+            new = candidate[scenario].get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+                continue
+            change = (new - old) / old if old else 0.0
+            worse = -change * direction(metric)
+            flag = "  REGRESSION" if worse > threshold else ""
+            print(f"  {metric:<24} {old:>14.4g} -> {new:<14.4g} {change:+.1%}{flag}")
+            if flag:
+                regressions.append((scenario, metric, change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two bench.run result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative slowdown")
+    args = parser.parse_args(argv)
+
+    regressions = compare(load(args.baseline), load(args.candidate), args.threshold)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+class FakeLLMServer:
+    """A local OpenAI-style chat completions endpoint that streams SSE.
+
+    Each response waits ``first_token_latency`` seconds, then sends
+    ``tokens`` tokens ``token_latency`` seconds apart. ``in_flight_peak``
+    shows how many requests the client really ran at once. Clearing
+    ``healthy`` makes every request and health check fail with a 503.
+    """
+
+    def __init__(self, tokens=60, first_token_latency=0.2, token_latency=0.01, host="127.0.0.1", port=0):
+        self.tokens = tokens
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.prompt_chars = 0
+        self.in_flight = 0
+        self.in_flight_peak = 0
+        self.healthy = True
+        self.runner = None
+
+    @property
+    def endpoint(self):
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    async def models(self, request):
+        if not self.healthy:
+            return web.Response(status=503)
+        return web.json_response({"data": [{"id": "fake"}]})
+
+    async def handle(self, request):
+        if not self.healthy:
+            return web.Response(status=503, text="unavailable")
+        body = await request.json()
+        self.requests += 1
+        self.prompt_chars += sum(len(message["content"]) for message in body["messages"])
+        self.in_flight += 1
+        self.in_flight_peak = max(self.in_flight_peak, self.in_flight)
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await asyncio.sleep(self.first_token_latency)
+            for n in range(self.tokens):
+                if n:
+                    await asyncio.sleep(self.token_latency)
+                chunk = {"choices": [{"delta": {"content": f"token{n} "}}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        app.router.add_get("/v1/models", self.models)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        # Port 0 picks a free port
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
@@ -0,0 +1,191 @@
+import asyncio
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.types import User
+
+WORDS = (
+    "meeting release deploy tomorrow friday budget review draft please check "
+    "update question answer link thanks agreed blocked merged ticket call "
+    "schedule design server bug fix test launch notes lunch weekend"
+).split()
+
+class FakeMessage:
+    """The parts of a Telethon Message the app reads."""
+
+    __slots__ = ("id", "date", "text", "sender_id", "sender")
+
+    def __init__(self, id, date, text, sender_id, sender=None):
+        self.id = id
+        self.date = date
+        self.text = text
+        self.sender_id = sender_id
+        self.sender = sender
+
+class FakeDialog:
+    """The parts of a Telethon Dialog the app reads."""
+
+    def __init__(self, id, title, top_message, unread_count):
+        self.id = id
+        self.title = self.name = title
+        self.message = top_message
+        self.date = top_message.date
+        self.unread_count = unread_count
+        self.unread_mentions_count = 0
+        self.is_user = id > 0
+        self.is_channel = id < -1000000000000
+        self.is_group = id < 0 and not self.is_channel
+        self.entity = FakeEntity(id)
+        # Raw TL dialog
+        self.dialog = FakeEntity(id)
+        self.dialog.read_inbox_max_id = top_message.id - unread_count
+        self.dialog.top_message = top_message.id
+
+class FakeEntity:
+    def __init__(self, id):
+        self.id = id
+
+class FakeMessageIter:
+    """Async iterator over generated messages with Telethon's ``total``."""
+
+    def __init__(self, client, entity, *args):
+        chat_id = getattr(entity, "id", entity)
+        self.total = None
+        self._client = client
+        self._chat_id = chat_id
+        self._messages = client._iter_messages(chat_id, *args)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._messages.__anext__()
+        self.total = self._client.top[self._chat_id]
+        return message
+
+class FakeTelegramClient:
+    """A synthetic stand-in for TelegramClient with generated history.
+
+    Messages are generated on demand from their ids, so large histories
+    cost no memory. Every page of ``page_size`` messages and every dialog
+    listing waits ``rpc_latency`` seconds, like a round trip to Telegram.
+    """
+
+    def __init__(self, dialogs=50, messages=1000, unread=20, text_words=12,
+                 rpc_latency=0.0, page_size=100, seed=0):
+        self.messages = messages
+        self.text_words = text_words
+        self.rpc_latency = rpc_latency
+        self.page_size = page_size
+        self.seed = seed
+        self.started = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.requests = 0
+        self.acknowledged = []
+        self.sent = []
+        # Our own user id; generated senders are 2000 and up
+        self.self_id = 1999
+
+        # Alternate private chats, groups and channels
+        self.chat_ids = []
+        for n in range(dialogs):
+            kind = n % 3
+            if kind == 0:
+                self.chat_ids.append(1000 + n)
+            elif kind == 1:
+                self.chat_ids.append(-(1000 + n))
+            else:
+                self.chat_ids.append(-1000000000000 - n)
+        self.unread = {chat_id: min(unread, messages) for chat_id in self.chat_ids}
+        self.top = {chat_id: messages for chat_id in self.chat_ids}
+
+    def message(self, chat_id, message_id):
+        """Returns the generated message ``message_id`` of a chat."""
+        rng = random.Random(hash((self.seed, chat_id, message_id)))
+        text = " ".join(rng.choice(WORDS) for _ in range(self.text_words))
+        date = self.started + timedelta(minutes=message_id)
+        sender_id = 2000 + message_id % 7
+        # Like Telethon, most messages arrive with their sender attached
+        sender = self.user(sender_id) if message_id % 10 else None
+        return FakeMessage(message_id, date, text, sender_id, sender)
+
+    def user(self, user_id):
+        return User(id=user_id, first_name=f"User {user_id}", username=f"user{user_id}")
+
+    def add_messages(self, chat_id, count, unread=True):
+        """Appends ``count`` new messages to a chat, as if they had arrived."""
+        self.top[chat_id] += count
+        if unread:
+            self.unread[chat_id] += count
+
+    async def _round_trip(self):
+        self.requests += 1
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+        else:
+            await asyncio.sleep(0)
+
+    async def start(self):
+        return self
+
+    async def get_me(self):
+        await self._round_trip()
+        return self.user(self.self_id)
+
+    async def disconnect(self):
+        pass
+
+    async def get_dialogs(self):
+        await self._round_trip()
+        return [
+            FakeDialog(chat_id, f"Chat {chat_id}", self.message(chat_id, self.top[chat_id]), self.unread[chat_id])
+            for chat_id in self.chat_ids
+        ]
+
+    async def iter_dialogs(self):
+        for dialog in await self.get_dialogs():
+            yield dialog
+
+    def iter_messages(self, entity, limit=None, min_id=0, max_id=0, offset_id=0, offset_date=None,
+                      reverse=False, **kwargs):
+        """Yields messages like Telethon: newest first, or oldest first with ``reverse``.
+
+        Like Telethon's iterator, ``total`` holds the chat's message count
+        once iteration has started.
+        """
+        return FakeMessageIter(self, entity, limit, min_id, max_id, offset_id, offset_date, reverse)
+
+    async def _iter_messages(self, chat_id, limit, min_id, max_id, offset_id, offset_date, reverse):
+        top = self.top[chat_id]
+        low = min_id + 1
+        high = top if not max_id else min(top, max_id - 1)
+        if offset_id:
+            if reverse:
+                low = max(low, offset_id + 1)
+            else:
+                high = min(high, offset_id - 1)
+        if offset_date is not None and not reverse:
+            # Message n is sent n minutes after the start; keep those before offset_date
+            high = min(high, math.ceil((offset_date - self.started).total_seconds() / 60) - 1)
+        ids = range(low, high + 1) if reverse else range(high, low - 1, -1)
+        if limit is not None:
+            ids = ids[:limit]
+
+        for n, message_id in enumerate(ids):
+            if n % self.page_size == 0:
+                await self._round_trip()
+            yield self.message(chat_id, message_id)
+
+    async def get_entity(self, entity):
+        await self._round_trip()
+        if isinstance(entity, list):
+            return [self.user(getattr(item, "id", item)) for item in entity]
+        return self.user(getattr(entity, "id", entity))
+
+    async def send_read_acknowledge(self, entity, *args, **kwargs):
+        chat_id = getattr(entity, "id", entity)
+        self.unread[chat_id] = 0
+        self.acknowledged.append(chat_id)
+
+    async def send_message(self, entity, text):
+        self.sent.append((getattr(entity, "id", entity), text))
@@ -0,0 +1,293 @@
+"""Offline benchmarks against a fake Telegram client and a fake LLM server.
+
+Run from the repository root:
+
+    python -m bench.run sync --dialogs 200 --output sync.json
+    python -m bench.run all --output baseline.json
+
+Each scenario prints or writes one JSON result. "all" runs every scenario
+in its own process so peak RSS is measured per scenario.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import dialog_cache
+import llm
+import llm_cache
+import message_handler
+import message_store
+import retention
+from bench.fake_llm import FakeLLMServer
+from bench.fake_telegram import FakeTelegramClient
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def make_client(args):
+    return FakeTelegramClient(
+        dialogs=args.dialogs, messages=args.messages, unread=args.unread,
+        text_words=args.text_words, rpc_latency=args.rpc_latency,
+    )
+
+def make_llm_server(args):
+    return FakeLLMServer(tokens=args.tokens, first_token_latency=args.first_token, token_latency=args.token_latency)
+
+async def scenario_sync(args):
+    """First sync of every dialog, then a second pass after a tenth of them moved."""
+    client = make_client(args)
+    started = time.perf_counter()
+    totals = await message_handler.fetch_messages(client)
+    elapsed = time.perf_counter() - started
+
+    # Two new messages in a tenth of the chats, then sync again
+    for chat_id in client.chat_ids[::10]:
+        client.add_messages(chat_id, 2)
+    dialog_cache.invalidate()
+    started = time.perf_counter()
+    resync = await message_handler.fetch_messages(client)
+    resync_elapsed = time.perf_counter() - started
+
+    return {
+        "elapsed": elapsed,
+        "messages": totals["messages"],
+        "messages_per_second": totals["messages"] / elapsed,
+        "db_writes_per_second": totals["written"] / elapsed,
+        "telegram_requests": client.requests,
+        "resync_elapsed": resync_elapsed,
+        "resync_unchanged": resync["unchanged"],
+    }
+
+async def scenario_fetch_unread(args):
+    """Stores the unread messages of every dialog and marks them read."""
+    client = make_client(args)
+    started = time.perf_counter()
+    await message_handler.fetch_unread_messages(client)
+    elapsed = time.perf_counter() - started
+    messages = args.dialogs * min(args.unread, args.messages)
+    return {
+        "elapsed": elapsed,
+        "messages": messages,
+        "messages_per_second": messages / elapsed,
+        "telegram_requests": client.requests,
+    }
+
+async def scenario_store(args):
+    """Raw batched inserts through MessageWriter, without Telegram."""
+    date = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    text = " ".join(["benchmark"] * args.text_words)
+    rows = args.dialogs * args.messages
+    started = time.perf_counter()
+    for chat_id in range(1, args.dialogs + 1):
+        with message_store.MessageWriter(chat_id) as writer:
+            for message_id in range(1, args.messages + 1):
+                writer.add(message_id, date + timedelta(seconds=message_id), 2000, text)
+    elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    report = retention.maintain()
+    maintain_elapsed = time.perf_counter() - started
+    return {
+        "elapsed": elapsed,
+        "rows": rows,
+        "db_writes_per_second": rows / elapsed,
+        "maintain_elapsed": maintain_elapsed,
+        "maintain_rows": report["rows"],
+        "maintain_bytes": report["bytes"],
+    }
+
+async def scenario_summarize(args):
+    """summarize_all_unread end to end, streaming from the fake LLM."""
+    client = make_client(args)
+    async with make_llm_server(args) as server:
+        llm.LLM_ENDPOINT = server.endpoint
+        started = time.perf_counter()
+        await message_handler.summarize_all_unread(client)
+        elapsed = time.perf_counter() - started
+        await llm.close_session()
+    return {
+        "elapsed": elapsed,
+        "chats": len(client.acknowledged),
+        "llm_requests": server.requests,
+        "llm_prompt_chars": server.prompt_chars,
+        "llm_in_flight_peak": server.in_flight_peak,
+    }
+
+async def scenario_llm(args):
+    """Concurrent streaming generations: time to first token and throughput."""
+    async with make_llm_server(args) as server:
+        llm.LLM_ENDPOINT = server.endpoint
+        semaphore = asyncio.Semaphore(max(1, args.concurrency))
+
+        async def one(n):
+            async with semaphore:
+                return await llm.complete(f"Benchmark prompt {n}", use_cache=False)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one(n) for n in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        await llm.close_session()
+
+    first_token = [result.time_to_first_token for result in results]
+    return {
+        "elapsed": elapsed,
+        "requests": len(results),
+        "requests_per_second": len(results) / elapsed,
+        "tokens_per_second": sum(result.tokens for result in results) / elapsed,
+        "first_token_p50": statistics.median(first_token),
+        "first_token_p95": percentile(first_token, 0.95),
+        "total_time_p50": statistics.median(result.total_time for result in results),
+        "llm_in_flight_peak": server.in_flight_peak,
+    }
+
+async def _time_command(argv, cwd, env):
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *argv, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    output, _ = await process.communicate()
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError(f"{' '.join(argv)} failed: {output.decode(errors='replace')[-500:]}")
+    return elapsed
+
+async def scenario_startup(args):
+    """Wall time of main.py commands that need no Telegram connection."""
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    chat_id = 1000
+    with message_store.MessageWriter(chat_id) as writer:
+        for message_id in range(1, 51):
+            writer.add(message_id, datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=message_id), 2000, "hello there")
+    message_store.close_backend()
+
+    # Commands run in the parent of the temporary store, which they find
+    # as the relative DB_DIR
+    cwd, db_name = os.path.split(message_store.DB_DIR)
+    os.rename(message_store.DB_DIR, os.path.join(cwd, "chat_databases"))
+    try:
+        async with make_llm_server(args) as server:
+            env = dict(os.environ, TELEGRAM_API_ID="1", TELEGRAM_API_HASH="bench",
+                       STORAGE_BACKEND=args.backend, LLM_ENDPOINT=server.endpoint, LLM_CACHE="off")
+            commands = {
+                "import": [sys.executable, "-c", f"import sys; sys.path.insert(0, {os.path.dirname(main_py)!r}); import main"],
+                "maintain": [sys.executable, main_py, "maintain"],
+                "retention": [sys.executable, main_py, "retention", str(chat_id), "default"],
+                "reply_draft_only": [sys.executable, main_py, "reply", str(chat_id), "--draft-only"],
+            }
+            metrics = {}
+            for name, argv in commands.items():
+                runs = [await _time_command(argv, cwd, env) for _ in range(args.runs)]
+                metrics[f"{name}_elapsed"] = statistics.median(runs)
+                metrics[f"{name}_elapsed_min"] = min(runs)
+    finally:
+        os.rename(os.path.join(cwd, "chat_databases"), message_store.DB_DIR)
+    return metrics
+
+SCENARIOS = {
+    "sync": scenario_sync,
+    "fetch-unread": scenario_fetch_unread,
+    "store": scenario_store,
+    "summarize": scenario_summarize,
+    "llm": scenario_llm,
+    "startup": scenario_startup,
+}
+
+def run_scenario(name, args):
+    """Runs one scenario against a fresh store and returns its result."""
+    message_store.STORAGE_BACKEND = args.backend
+    message_handler.LLM_CONCURRENCY = args.concurrency
+    llm.ENDPOINT_CONCURRENCY = args.concurrency
+    message_handler.SYNC_CONCURRENCY = args.sync_concurrency
+    message_handler.SYNC_RATE = args.sync_rate
+    llm_cache.LLM_CACHE_ENABLED = False
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        message_store.DB_DIR = db_dir
+        output = io.StringIO()
+        try:
+            # The app reports progress on stdout; keep the JSON clean
+            with contextlib.redirect_stdout(output if not args.verbose else sys.stderr):
+                metrics = asyncio.run(SCENARIOS[name](args))
+        finally:
+            message_store.close_backend()
+            llm_cache.close()
+
+    metrics["peak_rss"] = peak_rss()
+    return {
+        "scenario": name,
+        "params": {key: value for key, value in vars(args).items() if key not in ("scenario", "output", "verbose")},
+        "metrics": metrics,
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the sync and summary paths.")
+    parser.add_argument("scenario", choices=[*SCENARIOS, "all"])
+    parser.add_argument("--dialogs", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=1000, help="history length of each dialog")
+    parser.add_argument("--unread", type=int, default=20, help="unread messages in each dialog")
+    parser.add_argument("--text-words", type=int, default=12, help="words per message")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds per fake Telegram request")
+    parser.add_argument("--sync-concurrency", type=int, default=message_handler.SYNC_CONCURRENCY)
+    parser.add_argument("--sync-rate", type=float, default=message_handler.SYNC_RATE, help="Telegram requests per second")
+    parser.add_argument("--tokens", type=int, default=60, help="tokens per fake LLM response")
+    parser.add_argument("--first-token", type=float, default=0.2, help="fake LLM time to first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="fake LLM seconds between tokens")
+    parser.add_argument("--requests", type=int, default=32, help="generations in the llm scenario")
+    parser.add_argument("--runs", type=int, default=5, help="repetitions of each startup command")
+    parser.add_argument("--concurrency", type=int, default=message_handler.LLM_CONCURRENCY)
+    parser.add_argument("--backend", choices=["per-chat", "consolidated"], default=message_store.STORAGE_BACKEND)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output on stderr")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+
+    if args.scenario == "all":
+        # One process per scenario keeps peak RSS separate
+        results = []
+        rest = [arg for arg in argv if arg != "all"]
+        if "--output" in rest:
+            index = rest.index("--output")
+            del rest[index:index + 2]
+        for name in SCENARIOS:
+            completed = subprocess.run(
+                [sys.executable, "-m", "bench.run", name, *rest],
+                check=True, stdout=subprocess.PIPE, text=True
+            )
+            results.append(json.loads(completed.stdout))
+    else:
+        results = run_scenario(args.scenario, args)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import random
+import re
+import zlib
+
+# Messages shorter than this are left alone; collapsing "ok" or "thanks"
+# across chats would only lose context
+MIN_DEDUP_CHARS = 80
+SHINGLE_WORDS = 3
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16  # Rows per band: NUM_PERMUTATIONS // LSH_BANDS
+SIMILARITY_THRESHOLD = 0.8
+CHARS_PER_TOKEN = 4
+
+# Counters for this process
+collapsed = 0
+tokens_saved = 0
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+def normalize(text):
+    """Lowercases text and collapses whitespace, so reformatted copies match."""
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+def shingles(text):
+    """Returns the hashed word shingles of normalized text."""
+    words = text.split(" ")
+    if len(words) <= SHINGLE_WORDS:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+
+def signature(text):
+    """Returns the MinHash signature of normalized text."""
+    hashes = shingles(text)
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+def similarity(sig_a, sig_b):
+    """Estimates the Jaccard similarity of two texts from their signatures."""
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+def find_duplicates(texts):
+    """Groups near-duplicate texts with MinHash and LSH banding.
+
+    Returns a list of groups, each a sorted list of indexes into ``texts``
+    with at least two members. Short texts are never grouped.
+    """
+    signatures = {}
+    memo = {}  # Exact copies share one signature
+    for index, text in enumerate(texts):
+        if len(text) < MIN_DEDUP_CHARS:
+            continue
+        key = normalize(text)
+        if key not in memo:
+            memo[key] = signature(key)
+        signatures[index] = memo[key]
+
+    # Texts that agree on every row of some band become candidate pairs
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    parent = {index: index for index in signatures}
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for band in range(LSH_BANDS):
+        buckets = {}
+        for index, sig in signatures.items():
+            buckets.setdefault(sig[band * rows:(band + 1) * rows], []).append(index)
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                root_a, root_b = find(first), find(other)
+                if root_a != root_b and similarity(signatures[first], signatures[other]) >= SIMILARITY_THRESHOLD:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = {}
+    for index in signatures:
+        groups.setdefault(find(index), []).append(index)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+def collapse_repeats(chats):
+    """Collapses repeated messages across chats before prompts are built.
+
+    ``chats`` is a list of (title, messages) pairs in summary order, with
+    messages as (timestamp, sender, text, telegram_id) rows. The first copy
+    of each repeated message is kept and notes where else it appeared; the
+    other copies are dropped. Returns the new message lists, the number of
+    messages removed, the estimated tokens saved and, for each chat, the
+    indexes of the other chats holding the kept copies of its dropped
+    messages.
+    """
+    global collapsed, tokens_saved
+    flat = [(chat, row) for chat, (_, messages) in enumerate(chats) for row in messages]
+    groups = find_duplicates([row[2] for _, row in flat])
+
+    dropped = set()
+    keepers = [set() for _ in chats]
+    notes = {}
+    saved_chars = 0
+    for group in groups:
+        keep, *copies = group
+        dropped.update(copies)
+        for index in copies:
+            if flat[index][0] != flat[keep][0]:
+                keepers[flat[index][0]].add(flat[keep][0])
+        saved_chars += sum(len(flat[index][1][2]) for index in copies)
+
+        # Note where the message appeared, in summary order
+        counts = {}
+        for index in group:
+            title = chats[flat[index][0]][0]
+            counts[title] = counts.get(title, 0) + 1
+        if len(counts) == 1:
+            notes[keep] = f"[repeated {len(group)} times]"
+        else:
+            places = ", ".join(title if count == 1 else f"{title} x{count}" for title, count in counts.items())
+            notes[keep] = f"[posted {len(group)} times in: {places}]"
+
+    result = [[] for _ in chats]
+    for index, (chat, row) in enumerate(flat):
+        if index in dropped:
+            continue
+        if index in notes:
+            row = (row[0], row[1], f"{row[2]} {notes[index]}", *row[3:])
+        result[chat].append(row)
+
+    saved_tokens = saved_chars // CHARS_PER_TOKEN
+    collapsed += len(dropped)
+    tokens_saved += saved_tokens
+    return result, len(dropped), saved_tokens, keepers
+
+def stats():
+    """Returns the collapse counters for this process."""
+    return {"collapsed": collapsed, "tokens_saved": tokens_saved}
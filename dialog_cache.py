@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import time
+
+import message_store
+import metrics
+
+# Seconds a snapshot saved to disk stays valid for later runs; 0 keeps it in
+# memory for the current run only
+DIALOG_CACHE_TTL = 0
+DIALOG_CACHE_NAME = "dialogs.json"
+# Unread counts of every live listing are kept for the stats report, at
+# most once per this many seconds; 0 turns the history off
+UNREAD_HISTORY_INTERVAL = 600
+UNREAD_HISTORY_NAME = "unread_history.db"
+
+# One snapshot per account index
+_snapshots = {}
+
+class DialogInfo:
+    """The parts of a Telegram dialog needed by sync and summarization."""
+
+    def __init__(self, id, title, unread_count, top_message_id, read_inbox_max_id=0,
+                 unread_mentions_count=0, kind=None, last_message_at=0, dialog=None):
+        self.id = id
+        self.title = title
+        self.unread_count = unread_count
+        self.top_message_id = top_message_id
+        # Newest message we have read; unread messages are above it
+        self.read_inbox_max_id = read_inbox_max_id
+        # Unread mentions and replies to our own messages
+        self.unread_mentions_count = unread_mentions_count
+        self.kind = kind or ("user" if id > 0 else "group")  # "user", "group" or "channel"
+        self.last_message_at = last_message_at  # Unix time of the newest message
+        # Live Telethon dialog; None when loaded from disk
+        self.dialog = dialog
+
+    @property
+    def entity(self):
+        """Returns what Telethon calls should be given for this chat."""
+        return self.dialog.entity if self.dialog is not None else self.id
+
+    @classmethod
+    def from_dialog(cls, dialog):
+        top_message = getattr(dialog, "message", None)
+        top_date = getattr(top_message, "date", None) or getattr(dialog, "date", None)
+        if getattr(dialog, "is_user", False):
+            kind = "user"
+        elif getattr(dialog, "is_group", False):
+            kind = "group"  # Supergroups are channels that are also groups
+        elif getattr(dialog, "is_channel", False):
+            kind = "channel"
+        else:
+            kind = None
+        return cls(
+            id=dialog.id,
+            title=getattr(dialog, "title", None) or f"Chat {dialog.id}",
+            unread_count=dialog.unread_count,
+            top_message_id=top_message.id if top_message is not None else 0,
+            read_inbox_max_id=getattr(dialog.dialog, "read_inbox_max_id", 0) or 0,
+            unread_mentions_count=getattr(dialog, "unread_mentions_count", 0) or 0,
+            kind=kind,
+            last_message_at=top_date.timestamp() if top_date is not None else 0,
+            dialog=dialog,
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "unread_count": self.unread_count,
+            "top_message_id": self.top_message_id,
+            "read_inbox_max_id": self.read_inbox_max_id,
+            "unread_mentions_count": self.unread_mentions_count,
+            "kind": self.kind,
+            "last_message_at": self.last_message_at,
+        }
+
+class DialogSnapshot:
+    """All dialogs at one point in time, in Telegram order, indexed by chat id."""
+
+    def __init__(self, dialogs, taken_at=None):
+        self.dialogs = list(dialogs)
+        self.by_id = {info.id: info for info in self.dialogs}
+        self.taken_at = taken_at or time.time()
+
+    def __iter__(self):
+        return iter(self.dialogs)
+
+    def __len__(self):
+        return len(self.dialogs)
+
+    def get(self, chat_id):
+        """Returns the DialogInfo for a chat, or None if it is not listed."""
+        return self.by_id.get(chat_id)
+
+    def with_unread(self):
+        """Returns the dialogs that have unread messages, in Telegram order."""
+        return [info for info in self.dialogs if info.unread_count > 0]
+
+    def mark_read(self, chat_id):
+        """Records that a chat was acknowledged, keeping the snapshot current."""
+        info = self.by_id.get(chat_id)
+        if info is not None:
+            info.unread_count = 0
+            info.unread_mentions_count = 0
+            info.read_inbox_max_id = max(info.read_inbox_max_id, info.top_message_id)
+            if DIALOG_CACHE_TTL > 0:
+                self.save()
+
+    def is_fresh(self):
+        return time.time() - self.taken_at < DIALOG_CACHE_TTL
+
+    def save(self):
+        os.makedirs(message_store.DB_DIR, exist_ok=True)
+        path = get_cache_path()
+        with open(path + ".tmp", "w") as f:
+            json.dump({"taken_at": self.taken_at, "dialogs": [info.to_dict() for info in self.dialogs]}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls):
+        """Loads the snapshot saved on disk, or returns None."""
+        try:
+            with open(get_cache_path()) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls([DialogInfo(**entry) for entry in data["dialogs"]], data["taken_at"])
+
+def get_cache_path():
+    account = message_store.current_account.get()
+    if not account:
+        return os.path.join(message_store.DB_DIR, DIALOG_CACHE_NAME)
+    name, ext = os.path.splitext(DIALOG_CACHE_NAME)
+    return os.path.join(message_store.DB_DIR, f"{name}_{account}{ext}")
+
+async def get_snapshot(client, refresh=False):
+    """Returns the dialog snapshot for this run, listing dialogs only once.
+
+    With DIALOG_CACHE_TTL set, a fresh snapshot saved by an earlier run is
+    reused instead of listing dialogs again. Each account has its own.
+    """
+    account = message_store.current_account.get()
+    snapshot = _snapshots.get(account)
+    if snapshot is not None and not refresh:
+        return snapshot
+
+    if DIALOG_CACHE_TTL > 0 and not refresh:
+        saved = DialogSnapshot.load()
+        if saved is not None and saved.is_fresh():
+            _snapshots[account] = saved
+            return saved
+
+    with metrics.timer("telegram_get_dialogs_seconds"):
+        dialogs = await client.get_dialogs()
+    snapshot = _snapshots[account] = DialogSnapshot(DialogInfo.from_dialog(dialog) for dialog in dialogs)
+    if DIALOG_CACHE_TTL > 0:
+        snapshot.save()
+    if not account:
+        # Chat ids are the first account's; totals would mix accounts
+        record_unread_history(snapshot)
+    return snapshot
+
+def invalidate():
+    """Drops the in-memory snapshots so the next call lists dialogs again."""
+    _snapshots.clear()
+
+def _history_connection():
+    os.makedirs(message_store.DB_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(message_store.DB_DIR, UNREAD_HISTORY_NAME))
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS unread_history (
+        taken_at REAL,
+        chat_id INTEGER,
+        unread_count INTEGER
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_unread_history_taken_at ON unread_history (taken_at)")
+    return conn
+
+def record_unread_history(snapshot):
+    """Appends the unread counts of a live snapshot to the unread history.
+
+    Only chats with unread messages are stored; the others count as 0.
+    """
+    if UNREAD_HISTORY_INTERVAL <= 0:
+        return
+    conn = _history_connection()
+    try:
+        last = conn.execute("SELECT MAX(taken_at) FROM unread_history").fetchone()[0]
+        if last is not None and snapshot.taken_at - last < UNREAD_HISTORY_INTERVAL:
+            return
+        with conn:
+            # A row for chat 0 marks a listing in which nothing was unread
+            rows = [(snapshot.taken_at, info.id, info.unread_count) for info in snapshot.with_unread()]
+            conn.executemany("INSERT INTO unread_history VALUES (?, ?, ?)", rows or [(snapshot.taken_at, 0, 0)])
+    finally:
+        conn.close()
+
+def load_unread_history(since=0):
+    """Returns the (taken_at, chat_id, unread_count) rows recorded after ``since``."""
+    if not os.path.exists(os.path.join(message_store.DB_DIR, UNREAD_HISTORY_NAME)):
+        return []
+    conn = _history_connection()
+    try:
+        return conn.execute(
+            "SELECT taken_at, chat_id, unread_count FROM unread_history WHERE taken_at >= ? ORDER BY taken_at",
+            (since,)
+        ).fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+import accounts
+import llm
+import message_handler
+from message_store import (
+    MESSAGE_HISTORY_LIMIT,
+    get_draft,
+    get_last_message,
+    get_recent_messages,
+    get_sync_info,
+    save_draft,
+)
+
+DEBUG = True
+
+# Off by default: every chat with a new inbound message costs a generation
+PRECOMPUTE_DRAFTS = False
+# Drafts older than this are generated again when reply is run
+DRAFT_MAX_AGE = 24 * 3600
+# Most drafts generated after one ingestion pass; fetch passes the chats in
+# dialog order, most recent first
+DRAFT_MAX_CHATS = 20
+
+# Chats waiting for a draft while watching, and the task writing them
+_queued = set()
+_worker = None
+
+def fresh_draft(chat_id, now=None):
+    """Returns the stored draft of a chat if nothing arrived since it was written, else None."""
+    draft = get_draft(chat_id)
+    if draft is None:
+        return None
+    now = time.time() if now is None else now
+    if draft["based_on_id"] != get_sync_info(chat_id) or now - draft["created_at"] > DRAFT_MAX_AGE:
+        return None
+    return draft
+
+def needs_draft(chat_id):
+    """Returns True if a chat's newest message is from someone else and has no fresh draft."""
+    last = get_last_message(chat_id)
+    if last is None:
+        return False
+    _, sender_id = last
+    # Channel posts are sent by the channel itself, which has a negative id
+    if not sender_id or sender_id < 0 or sender_id == accounts.self_id():
+        return False
+    return fresh_draft(chat_id) is None
+
+async def _write_draft(chat_id, semaphore):
+    # Read the position first; a message arriving during generation leaves
+    # the draft stale instead of passing it off as covering that message
+    based_on_id = get_sync_info(chat_id)
+    recent_messages = get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT)
+    if not recent_messages:
+        return False
+    async with semaphore:
+        draft = await message_handler.generate(message_handler.reply_prompt(recent_messages), stream_output=False)
+    save_draft(chat_id, draft, based_on_id)
+    return True
+
+async def precompute(chat_ids):
+    """Generates reply drafts for the chats among ``chat_ids`` waiting on a reply.
+
+    Does nothing unless PRECOMPUTE_DRAFTS is set. Chats whose newest
+    message is our own, or that already have a fresh draft, are skipped.
+    Returns the number of drafts written.
+    """
+    if not PRECOMPUTE_DRAFTS:
+        return 0
+    started = time.monotonic()
+    chat_ids = [chat_id for chat_id in dict.fromkeys(chat_ids) if needs_draft(chat_id)]
+    if len(chat_ids) > DRAFT_MAX_CHATS:
+        if DEBUG: print(f"Drafting replies for {DRAFT_MAX_CHATS} of {len(chat_ids)} chats")
+        chat_ids = chat_ids[:DRAFT_MAX_CHATS]
+    if not chat_ids:
+        return 0
+
+    semaphore = asyncio.Semaphore(max(message_handler.LLM_CONCURRENCY, llm.capacity()))
+    results = await asyncio.gather(*(_write_draft(chat_id, semaphore) for chat_id in chat_ids),
+                                   return_exceptions=True)
+    written = 0
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, BaseException):
+            print(f"Failed to draft a reply for chat {chat_id}: {result}")
+        else:
+            written += result
+    if DEBUG: print(f"Drafted {written} replies in {time.monotonic() - started:.1f}s")
+    return written
+
+def schedule(chat_ids):
+    """Queues chats for precompute in the background, for callers that cannot wait on the LLM."""
+    global _worker
+    if not PRECOMPUTE_DRAFTS:
+        return
+    _queued.update(chat_ids)
+    if _queued and (_worker is None or _worker.done()):
+        _worker = asyncio.create_task(_drain())
+
+async def _drain():
+    # Chats queued while a pass runs are picked up by the next one
+    while _queued:
+        chat_ids = list(_queued)
+        _queued.clear()
+        await precompute(chat_ids)
+
+async def stop():
+    """Cancels drafts still being written in the background."""
+    global _worker
+    _queued.clear()
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None
@@ -0,0 +1,454 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+
+import llm_cache
+import metrics
+
+# OpenAI-compatible chat completions endpoint
+LLM_ENDPOINT = "http://localhost:8000/v1/chat/completions"
+# Inference servers to spread requests over, each "url" or "url|max
+# concurrent requests"; empty uses LLM_ENDPOINT alone
+LLM_ENDPOINTS = []
+ENDPOINT_CONCURRENCY = 4  # Default limit of concurrent requests per endpoint
+LLM_MODEL = "tiiuae/Falcon3-1B-Instruct"
+LLM_TEMPERATURE = 0.0
+
+# Seconds allowed to open the connection, to receive the first token and
+# for the whole generation
+CONNECT_TIMEOUT = 10
+FIRST_TOKEN_TIMEOUT = 120
+TOTAL_TIMEOUT = 600
+
+# Keep-alive connections kept open to the inference server
+MAX_CONNECTIONS = 16
+
+# Consecutive failures that take an endpoint out of rotation, seconds until
+# it is health checked again, and seconds allowed for that check
+CIRCUIT_FAILURES = 3
+CIRCUIT_COOLDOWN = 30
+HEALTH_CHECK_TIMEOUT = 5
+
+QUEUE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)  # Waiting requests
+
+DEBUG = True
+
+_session = None
+_pool = None
+
+class LLMError(Exception):
+    """Raised when the LLM endpoint fails or times out.
+
+    ``status`` is the HTTP status, or None when no response arrived.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def endpoint_failure(self):
+        """True when the server, not the request, is at fault."""
+        return self.status is None or self.status == 429 or self.status >= 500
+
+class Endpoint:
+    """One inference server with its concurrency limit, health and stats."""
+
+    def __init__(self, url, max_concurrency):
+        self.url = url
+        self.max_concurrency = max(1, max_concurrency)
+        self.outstanding = 0
+        self.outstanding_peak = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # Consecutive; CIRCUIT_FAILURES opens the circuit
+        self.open_until = 0.0
+        self.checking = False
+        self.completed = 0
+        self.first_token_total = 0.0
+        self.latency_total = 0.0
+
+    @property
+    def tripped(self):
+        return self.failures >= CIRCUIT_FAILURES
+
+    @property
+    def mean_first_token(self):
+        return self.first_token_total / self.completed if self.completed else 0.0
+
+    def cooling_down(self, now):
+        return self.tripped and (now < self.open_until or self.checking)
+
+    def has_slot(self):
+        return self.outstanding < self.max_concurrency
+
+    @property
+    def health_url(self):
+        """The model listing next to an OpenAI-style endpoint, if there is one."""
+        if self.url.endswith("/chat/completions"):
+            return self.url[:-len("/chat/completions")] + "/models"
+        return None
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "max_concurrency": self.max_concurrency,
+            "outstanding": self.outstanding,
+            "outstanding_peak": self.outstanding_peak,
+            "requests": self.requests,
+            "errors": self.errors,
+            "healthy": not self.tripped,
+            "mean_first_token": self.mean_first_token,
+            "mean_latency": self.latency_total / self.completed if self.completed else 0.0,
+        }
+
+class EndpointPool:
+    """Routes generations to the healthy endpoint with the fewest in flight.
+
+    Requests wait in one shared queue until an endpoint has a free slot.
+    After CIRCUIT_FAILURES failures in a row an endpoint is skipped for
+    CIRCUIT_COOLDOWN seconds, then health checked before it gets traffic
+    again; one more failure takes it out for another cooldown.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.endpoints = [Endpoint(url, limit) for url, limit in config]
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Condition()
+        self.waiting = 0
+        self.waiting_peak = 0
+        self.queued = 0
+        self.wait_total = 0.0
+
+    def _pick(self, exclude):
+        """Returns the least loaded usable endpoint, or None if all are busy.
+
+        Raises LLMError when no endpoint outside ``exclude`` can be used.
+        """
+        now = time.monotonic()
+        usable = [endpoint for endpoint in self.endpoints
+                  if endpoint not in exclude and not endpoint.cooling_down(now)]
+        if not usable:
+            raise LLMError("No healthy LLM endpoint is available")
+        free = [endpoint for endpoint in usable if endpoint.has_slot()]
+        if not free:
+            return None
+        # Ties go to the endpoint that has been answering fastest
+        return min(free, key=lambda endpoint: (endpoint.outstanding, endpoint.mean_first_token))
+
+    async def acquire(self, exclude=()):
+        """Waits for an endpoint slot and returns the endpoint; raises LLMError."""
+        started = time.monotonic()
+        self.waiting += 1
+        self.queued += 1
+        self.waiting_peak = max(self.waiting_peak, self.waiting)
+        metrics.observe("llm_queue_depth", self.waiting, buckets=QUEUE_BUCKETS)
+        try:
+            while True:
+                async with self.changed:
+                    endpoint = self._pick(exclude)
+                    while endpoint is None:
+                        await self.changed.wait()
+                        endpoint = self._pick(exclude)
+                    if not endpoint.tripped:
+                        endpoint.outstanding += 1
+                        endpoint.requests += 1
+                        endpoint.outstanding_peak = max(endpoint.outstanding_peak, endpoint.outstanding)
+                        break
+                    # Cooled down: check it before sending real traffic
+                    endpoint.checking = True
+
+                healthy = False
+                try:
+                    healthy = await self._check(endpoint)
+                finally:
+                    # Also when the check is cancelled or raises, so the
+                    # endpoint is probed again after its cooldown
+                    async with self.changed:
+                        endpoint.checking = False
+                        if healthy:
+                            # Half open: the next failure trips it again
+                            endpoint.failures = CIRCUIT_FAILURES - 1
+                            if DEBUG: print(f"LLM endpoint {endpoint.url} is back in rotation")
+                        else:
+                            endpoint.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+                        self.changed.notify_all()
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        metrics.observe("llm_queue_wait_seconds", waited)
+        metrics.observe("llm_endpoint_outstanding", endpoint.outstanding,
+                        buckets=QUEUE_BUCKETS, endpoint=endpoint.url)
+        return endpoint
+
+    async def release(self, endpoint, ok, first_token=None, elapsed=None):
+        """Frees an endpoint slot and records how the request went."""
+        async with self.changed:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.failures = 0
+                if first_token is not None:
+                    endpoint.completed += 1
+                    endpoint.first_token_total += first_token
+                    endpoint.latency_total += elapsed
+            else:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.tripped:
+                    endpoint.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+                    metrics.inc("llm_circuit_open_total", endpoint=endpoint.url)
+                    if DEBUG: print(f"LLM endpoint {endpoint.url} failed {endpoint.failures} times; "
+                                    f"skipping it for {CIRCUIT_COOLDOWN}s")
+            self.changed.notify_all()
+
+    async def _check(self, endpoint):
+        """Returns True if the endpoint answers its health check."""
+        if endpoint.health_url is None:
+            return True  # Nothing to probe; the next request decides
+        import aiohttp
+
+        session = await get_session()
+        try:
+            async with session.get(endpoint.health_url,
+                                   timeout=aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "waiting": self.waiting,
+            "waiting_peak": self.waiting_peak,
+            "mean_queue_wait": self.wait_total / self.queued if self.queued else 0.0,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints],
+        }
+
+def endpoint_config():
+    """Returns the configured (url, max_concurrency) pairs."""
+    config = []
+    for entry in LLM_ENDPOINTS or [LLM_ENDPOINT]:
+        url, _, limit = entry.strip().partition("|")
+        if url:
+            config.append((url, int(limit) if limit else ENDPOINT_CONCURRENCY))
+    return config
+
+def capacity():
+    """Returns how many generations the endpoints can run at once."""
+    return sum(limit for _, limit in endpoint_config())
+
+def get_pool():
+    """Returns the endpoint pool, rebuilt when the configuration changes."""
+    global _pool
+    config = endpoint_config()
+    if _pool is None or _pool.config != config or _pool.loop is not asyncio.get_running_loop():
+        _pool = EndpointPool(config)
+    return _pool
+
+def stats():
+    """Returns queue and per-endpoint statistics of the current pool."""
+    if _pool is None:
+        return {"queued": 0, "waiting": 0, "waiting_peak": 0, "mean_queue_wait": 0.0, "endpoints": []}
+    return _pool.stats()
+
+@dataclass
+class LLMResult:
+    """Collected output of one generation and its timings."""
+    text: str
+    tokens: int
+    time_to_first_token: float
+    total_time: float
+    cached: bool = False
+
+    @property
+    def tokens_per_second(self):
+        # Generation speed after the first token, which excludes prompt processing
+        generating = self.total_time - (self.time_to_first_token or 0)
+        return self.tokens / generating if generating > 0 else 0.0
+
+async def get_session():
+    """Returns the shared HTTP session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        # Deferred so commands that never call the LLM skip importing aiohttp
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT),
+        )
+    return _session
+
+async def close_session():
+    """Closes the shared HTTP session and its pooled connections."""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+def build_payload(prompt, system_prompt=None, model=None, temperature=None):
+    """Builds the streaming chat completions request body."""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return {
+        "model": model or LLM_MODEL,
+        "stream": True,
+        "messages": messages,
+        "temperature": LLM_TEMPERATURE if temperature is None else temperature,
+    }
+
+def parse_sse_event(data):
+    """Returns the content delta of one SSE data payload, or None when done."""
+    if data == "[DONE]":
+        return None
+    try:
+        event = json.loads(data)
+    except json.JSONDecodeError:
+        return ""
+    choices = event.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+async def stream_chat(prompt, system_prompt=None, model=None, temperature=None, endpoint=None):
+    """Streams a chat completion and yields content tokens as they arrive.
+
+    Lines are parsed incrementally as server-sent events. Raises LLMError
+    on HTTP errors and timeouts. Cancelling the consuming task, or
+    leaving the loop early, closes the request.
+    """
+    import aiohttp
+
+    session = await get_session()
+    payload = build_payload(prompt, system_prompt, model, temperature)
+    deadline = time.monotonic() + TOTAL_TIMEOUT
+    first_token = True
+    data_lines = []
+
+    try:
+        async with session.post(endpoint or LLM_ENDPOINT, json=payload) as response:
+            if response.status != 200:
+                body = await response.text()
+                raise LLMError(f"LLM endpoint returned {response.status}: {body[:200]}", status=response.status)
+
+            while True:
+                remaining = deadline - time.monotonic()
+                if first_token:
+                    remaining = min(remaining, FIRST_TOKEN_TIMEOUT)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+
+                raw = await asyncio.wait_for(response.content.readline(), remaining)
+                if not raw and not data_lines:
+                    break  # Server closed the stream
+
+                # An empty read flushes an event the server did not terminate
+                line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+                if line.startswith("data:"):
+                    data_lines.append(line[5:].lstrip())
+                    continue
+                if line or not data_lines:
+                    continue  # Comments, other fields, or keep-alive blank lines
+
+                # A blank line ends the event
+                content = parse_sse_event("\n".join(data_lines))
+                data_lines = []
+                if content:
+                    first_token = False
+                    yield content
+                if content is None or not raw:
+                    break
+    except asyncio.TimeoutError:
+        stage = "first token" if first_token else "completion"
+        raise LLMError(f"Timed out waiting for {stage} from {endpoint or LLM_ENDPOINT}")
+    except aiohttp.ClientError as e:
+        raise LLMError(f"LLM request failed: {e}") from e
+
+async def complete(prompt, system_prompt=None, on_token=None, use_cache=True, **kwargs):
+    """Runs a streaming generation to the end and returns an LLMResult.
+
+    ``on_token`` is called with every token as it arrives, for example to
+    print the response live. Deterministic requests are answered from the
+    response cache when possible; a hit is passed to ``on_token`` in one
+    piece. Extra keyword arguments go to stream_chat.
+    """
+    started = time.monotonic()
+
+    temperature = kwargs.get("temperature")
+    if temperature is None:
+        temperature = LLM_TEMPERATURE
+    key = None
+    if use_cache and llm_cache.LLM_CACHE_ENABLED and temperature == 0:
+        key = llm_cache.cache_key(system_prompt, prompt, kwargs.get("model") or LLM_MODEL, temperature)
+        text = llm_cache.get(key)
+        if text is not None:
+            metrics.inc("llm_cache_hits_total")
+            if on_token:
+                on_token(text)
+            return LLMResult(text=text, tokens=0, time_to_first_token=0.0,
+                             total_time=time.monotonic() - started, cached=True)
+
+    # An explicit endpoint bypasses the pool
+    pool = None if kwargs.get("endpoint") else get_pool()
+    tried = set()
+    while True:
+        endpoint = None
+        if pool is not None:
+            endpoint = await pool.acquire(exclude=tried)
+            kwargs["endpoint"] = endpoint.url
+        url = kwargs["endpoint"]
+        attempt_started = time.monotonic()
+        first_token_at = None
+        parts = []
+
+        metrics.inc("llm_requests_total", endpoint=url)
+        try:
+            async for token in stream_chat(prompt, system_prompt, **kwargs):
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                parts.append(token)
+                if on_token:
+                    on_token(token)
+        except LLMError as e:
+            metrics.inc("llm_errors_total", endpoint=url)
+            if pool is None:
+                raise
+            await pool.release(endpoint, ok=not e.endpoint_failure)
+            tried.add(endpoint)
+            # Tokens already went to on_token, so only retry before the first
+            if first_token_at is not None or not e.endpoint_failure or len(tried) == len(pool.endpoints):
+                raise
+            if DEBUG: print(f"LLM endpoint {url} failed ({e}); retrying on another")
+            metrics.inc("llm_retries_total")
+            continue
+        except BaseException:
+            # Cancelled: not the endpoint's fault
+            if pool is not None:
+                await asyncio.shield(pool.release(endpoint, ok=True))
+            raise
+        if pool is not None:
+            await pool.release(endpoint, ok=True,
+                               first_token=(first_token_at - attempt_started) if first_token_at else None,
+                               elapsed=time.monotonic() - attempt_started)
+        break
+
+    finished = time.monotonic()
+    result = LLMResult(
+        text="".join(parts),
+        tokens=len(parts),  # One streamed delta per token
+        time_to_first_token=(first_token_at - started) if first_token_at else 0.0,
+        total_time=finished - started,
+    )
+    metrics.observe("llm_time_to_first_token_seconds", result.time_to_first_token, endpoint=url)
+    metrics.observe("llm_generation_seconds", result.total_time)
+    metrics.observe("llm_tokens_per_second", result.tokens_per_second, buckets=metrics.RATE_BUCKETS)
+    metrics.inc("llm_tokens_total", result.tokens)
+    if key is not None and result.text:
+        llm_cache.put(key, result.text)
+    return result
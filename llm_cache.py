@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import message_store
+
+# Responses are only cached for deterministic requests (temperature 0)
+LLM_CACHE_ENABLED = True
+LLM_CACHE_NAME = "llm_cache.db"
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+LLM_CACHE_MAX_AGE = 30 * 24 * 3600  # Seconds
+
+hits = 0
+misses = 0
+
+_conn = None
+
+def get_cache_path():
+    return os.path.join(message_store.DB_DIR, LLM_CACHE_NAME)
+
+def _connect():
+    global _conn
+    if _conn is None:
+        os.makedirs(message_store.DB_DIR, exist_ok=True)
+        _conn = sqlite3.connect(get_cache_path())
+        _conn.execute("PRAGMA journal_mode = WAL")
+        _conn.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            size INTEGER,
+            created REAL,
+            last_used REAL
+        )""")
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+        _conn.commit()
+    return _conn
+
+def close():
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+def cache_key(system_prompt, prompt, model, temperature):
+    """Hashes everything that determines a deterministic response."""
+    material = json.dumps([system_prompt, prompt, model, temperature], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def get(key):
+    """Returns the cached response for ``key``, or None, and counts the lookup."""
+    global hits, misses
+    conn = _connect()
+    row = conn.execute(
+        "SELECT response FROM responses WHERE key = ? AND created >= ?",
+        (key, time.time() - LLM_CACHE_MAX_AGE)
+    ).fetchone()
+    if row is None:
+        misses += 1
+        return None
+
+    hits += 1
+    with conn:
+        conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+    return row[0]
+
+def put(key, response):
+    """Stores a response and evicts old or least recently used entries."""
+    conn = _connect()
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, response, len(response.encode("utf-8")), now, now)
+        )
+    evict()
+
+def evict():
+    """Drops expired entries, then least recently used ones over the size limits."""
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - LLM_CACHE_MAX_AGE,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= LLM_CACHE_MAX_ENTRIES and total <= LLM_CACHE_MAX_BYTES:
+            return
+
+        # Walk from least recently used until both limits hold
+        to_delete = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+            if count <= LLM_CACHE_MAX_ENTRIES and total <= LLM_CACHE_MAX_BYTES:
+                break
+            to_delete.append((key,))
+            count -= 1
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+def stats():
+    """Returns hit/miss counters for this process."""
+    lookups = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / lookups if lookups else 0.0}
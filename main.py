@@ -1,73 +1,263 @@
 import asyncio
 import os
 import sys
+import time
+from datetime import datetime, timezone
 
-from telethon import TelegramClient, events
-
+import accounts
+import backfill
+import dialog_cache
+import drafts
+import llm
+import llm_cache
 import message_handler
+import message_store
+import metrics
+import priority
+import retention
+import service
+import stats
 
 # Get API credentials from environment variables
 api_id = os.environ.get("TELEGRAM_API_ID")
 api_hash = os.environ.get("TELEGRAM_API_HASH")
 session_name = os.environ.get("TELEGRAM_SESSION_NAME", "my_session")
-
-# Check if credentials are available
-if not api_id or not api_hash:
-    raise ValueError("Please set the TELEGRAM_API_ID and TELEGRAM_API_HASH environment variables")
-
-# Convert api_id to integer
-api_id = int(api_id)
+# Comma-separated session names of every monitored account, primary first
+account_sessions = [name.strip() for name in os.environ.get("TELEGRAM_ACCOUNTS", session_name).split(",") if name.strip()]
+storage_backend = os.environ.get("STORAGE_BACKEND", "per-chat")
+sync_concurrency = int(os.environ.get("SYNC_CONCURRENCY", message_handler.SYNC_CONCURRENCY))
+sync_rate = float(os.environ.get("SYNC_RATE", message_handler.SYNC_RATE))
+dialog_cache_ttl = float(os.environ.get("DIALOG_CACHE_TTL", dialog_cache.DIALOG_CACHE_TTL))
+llm_cache_enabled = os.environ.get("LLM_CACHE", "on").lower() not in ("0", "off", "false")
+llm_concurrency = int(os.environ.get("LLM_CONCURRENCY", message_handler.LLM_CONCURRENCY))
+llm_endpoint = os.environ.get("LLM_ENDPOINT", llm.LLM_ENDPOINT)
+# Comma-separated inference servers, each "url" or "url|max concurrent requests"
+llm_endpoints = [entry for entry in os.environ.get("LLM_ENDPOINTS", "").split(",") if entry.strip()]
+llm_endpoint_concurrency = int(os.environ.get("LLM_ENDPOINT_CONCURRENCY", llm_concurrency))
+# Seconds and estimated prompt tokens summarize-unread all may spend; 0 for no limit
+summary_time_budget = float(os.environ.get("SUMMARY_TIME_BUDGET", priority.SUMMARY_TIME_BUDGET))
+summary_token_budget = int(os.environ.get("SUMMARY_TOKEN_BUDGET", priority.SUMMARY_TOKEN_BUDGET))
+# Draft replies after fetch and watch so reply opens at once; off by default
+precompute_drafts = os.environ.get("PRECOMPUTE_DRAFTS", "off").lower() in ("1", "on", "true")
+draft_max_age = float(os.environ.get("DRAFT_MAX_AGE", drafts.DRAFT_MAX_AGE))
+# Our own user id on the primary account; learned on connect otherwise
+self_id = os.environ.get("TELEGRAM_SELF_ID")
+# Path of a Prometheus textfile (or *.json) written after each command
+metrics_file = os.environ.get("METRICS_FILE")
+# Unix socket of the serve daemon; defaults to one in the database directory
+socket_path = os.environ.get("NOTIFI_SOCKET")
 
 message_handler.API_ID = api_id
 message_handler.API_HASH = api_hash
 message_handler.SESSION_NAME = session_name
+accounts.ACCOUNTS = account_sessions
+message_store.STORAGE_BACKEND = storage_backend
+message_handler.SYNC_CONCURRENCY = sync_concurrency
+message_handler.SYNC_RATE = sync_rate
+message_handler.LLM_CONCURRENCY = llm_concurrency
+dialog_cache.DIALOG_CACHE_TTL = dialog_cache_ttl
+llm_cache.LLM_CACHE_ENABLED = llm_cache_enabled
+llm.LLM_ENDPOINT = llm_endpoint
+llm.LLM_ENDPOINTS = llm_endpoints
+llm.ENDPOINT_CONCURRENCY = llm_endpoint_concurrency
+drafts.PRECOMPUTE_DRAFTS = precompute_drafts
+drafts.DRAFT_MAX_AGE = draft_max_age
+priority.SUMMARY_TIME_BUDGET = summary_time_budget
+priority.SUMMARY_TOKEN_BUDGET = summary_token_budget
+metrics.METRICS_FILE = metrics_file
+metrics.METRICS_ENABLED = bool(metrics_file)
+service.SOCKET_PATH = socket_path
+if self_id:
+    accounts.SELF_IDS[account_sessions[0]] = int(self_id)
+
+_clients = {}
+
+async def get_client():
+    """Creates and starts the current account's Telegram client the first time a command needs it.
+
+    Local commands never get here, so they skip importing Telethon, loading
+    the session and connecting.
+    """
+    account = message_store.current_account.get()
+    client = _clients.get(account)
+    if client is None:
+        # Check if credentials are available
+        if not api_id or not api_hash:
+            raise ValueError("Please set the TELEGRAM_API_ID and TELEGRAM_API_HASH environment variables")
+
+        from telethon import TelegramClient
+
+        # One client per account, shared by all operations
+        client = _clients[account] = TelegramClient(accounts.ACCOUNTS[account], int(api_id), api_hash)
+        await client.start()
+        # Tells our own messages apart, also for commands that stay offline
+        accounts.remember_self((await client.get_me()).id, account)
+    return client
+
+def parse_date(text):
+    """Parses an ISO date or datetime given on the command line, as UTC if no zone is given."""
+    value = datetime.fromisoformat(text)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+async def run_command(argv):
+    """Runs one command line, without the process-wide setup and cleanup.
+
+    Used for commands run in this process and for requests to serve.
+    """
+    # --draft-only shows a suggested reply without connecting to Telegram
+    draft_only = "--draft-only" in argv
+    argv = [arg for arg in argv if arg != "--draft-only"]
+    # --account NAME runs the command as another configured account
+    account = None
+    if "--account" in argv:
+        index = argv.index("--account")
+        if index + 1 >= len(argv) or len(argv) < 3:
+            print(f"Usage: python main.py [command] --account [{'|'.join(accounts.ACCOUNTS)}]")
+            return
+        try:
+            account = accounts.account_index(argv[index + 1])
+        except ValueError as e:
+            print(e)
+            return
+        del argv[index:index + 2]
+        message_store.current_account.set(account)
+    command = argv[0]
+
+    if command == "fetch":
+        if len(accounts.ACCOUNTS) > 1 and account is None:
+            # Every account at once, shared chats only once
+            await accounts.fetch_all(get_client)
+        else:
+            totals = await message_handler.fetch_messages(await get_client())
+            await drafts.precompute(totals["updated_chats"])
+    elif command == "watch":
+        import watcher
+        await watcher.watch(await get_client())
+    elif command == "fetch-unread":
+        await message_handler.fetch_unread_messages(await get_client())
+    elif command == "analyze" and len(argv) >= 2:
+        # Reads the local store and the LLM only
+        chat_id = int(argv[1])
+        query = " ".join(argv[2:]) if len(argv) > 2 else None
+        await message_handler.analyze_chat(chat_id, query)
+    elif command == "summarize-unread" and len(argv) >= 2:
+        if argv[1].lower() == "all":
+            # Summarize unread messages from all chats
+            print("\n=== Summarizing all unread messages across all chats ===\n")
+            # Each chat's summary is printed as soon as it is ready
+            await message_handler.summarize_all_unread(await get_client(), on_result=print)
+        else:
+            # Summarize unread messages from a specific chat
+            chat_id = int(argv[1])
+            summary = await message_handler.summarize_unread(await get_client(), chat_id)
+            print("\n--- Summary of Unread Messages ---\n")
+            print(summary)
+    elif command == "reply" and len(argv) >= 2:
+        chat_id = int(argv[1])
+        client = None if draft_only else await get_client()
+        await message_handler.generate_reply(client, chat_id, draft_only=draft_only)
+    elif command == "backfill":
+        # backfill [chat_id ...] [--since DATE] [--until DATE]
+        chat_ids, since, until = [], None, None
+        args = iter(argv[1:])
+        for arg in args:
+            if arg == "--since":
+                since = parse_date(next(args))
+            elif arg == "--until":
+                until = parse_date(next(args))
+            else:
+                chat_ids.append(int(arg))
+        totals = await backfill.backfill(await get_client(), chat_ids or None, since=since, until=until)
+        print(backfill.format_report(totals))
+    elif command == "stats":
+        # stats [--days N]; reads the local store only
+        days = float(argv[2]) if len(argv) >= 3 and argv[1] == "--days" else None
+        print(stats.run(days=days))
+    elif command == "migrate":
+        message_store.migrate_to_consolidated()
+    elif command == "maintain":
+        # Retention pass, meant to be scheduled separately from syncing
+        print(retention.format_report(retention.maintain()))
+    elif command == "retention" and len(argv) >= 3:
+        chat_id = int(argv[1])
+        policy = argv[2]
+        if policy == "keep-all":
+            message_store.set_retention_policy(chat_id, keep_all=True)
+        elif policy == "messages" and len(argv) >= 4:
+            message_store.set_retention_policy(chat_id, max_messages=int(argv[3]))
+        elif policy == "days" and len(argv) >= 4:
+            message_store.set_retention_policy(chat_id, max_age=float(argv[3]) * 86400)
+        elif policy == "default":
+            message_store.clear_retention_policy(chat_id)
+        else:
+            print("Usage: python main.py retention [chat_id] [keep-all|messages N|days N|default]")
+            return
+        print(f"Retention for chat {chat_id}: {message_store.get_retention_policy(chat_id)}")
+    else:
+        print("Unknown command. Use one of:")
+        print("  fetch                       - Fetch all messages")
+        print("  fetch-unread                - Fetch only unread messages")
+        print("  watch                       - Keep storing new, edited and deleted messages as they happen")
+        print("  analyze [chat_id] [query]   - Answer a question from the most relevant stored messages")
+        print("  summarize-unread [chat_id]  - Summarize unread messages from a chat")
+        print("  summarize-unread all        - Summarize all unread messages across all chats")
+        print("  reply [chat_id]             - Generate and send a reply to a chat")
+        print("  reply [chat_id] --draft-only - Only suggest a reply, from the local store")
+        print("                                (with PRECOMPUTE_DRAFTS, fetch and watch draft replies ahead of time)")
+        print("  backfill [chat_id ...] [--since DATE] [--until DATE] - Import older history, resuming where the last run stopped")
+        print("  stats [--days N]            - Activity, top senders, reply times and unread history from the store")
+        print("  migrate                     - Import per-chat databases into the consolidated store")
+        print("  maintain                    - Delete messages past each chat's retention policy and reclaim space")
+        print("  retention [chat_id] [policy] - Set a chat's retention: keep-all, messages N, days N or default")
+        print("  --account NAME              - Run any command as another account from TELEGRAM_ACCOUNTS")
+        print("  serve                       - Stay connected and run commands for other invocations")
 
 async def main():
+    # --no-cache bypasses the LLM response cache for this run
+    no_cache = "--no-cache" in sys.argv
+    if no_cache:
+        sys.argv.remove("--no-cache")
+        llm_cache.LLM_CACHE_ENABLED = False
+
     if len(sys.argv) < 2:
-        print("Usage: python main.py [fetch|fetch-unread|analyze|summarize-unread|reply] [chat_id] [query]")
+        print("Usage: python main.py [fetch|fetch-unread|watch|analyze|summarize-unread|reply|backfill|stats|migrate|maintain|retention|serve] [chat_id] [query]")
+        return
+
+    argv = sys.argv[1:]
+
+    # A running daemon is already connected; --no-cache needs this process
+    if not no_cache and service.handles(argv) and await service.call(argv):
         return
-        
-    command = sys.argv[1]
-    
-    # Create a single client for all operations
-    client = TelegramClient(session_name, api_id, api_hash)
-    await client.start()
-    
+
     try:
-        if command == "fetch":
-            await message_handler.fetch_messages(client)
-        elif command == "fetch-unread":
-            await message_handler.fetch_unread_messages(client)
-        elif command == "analyze" and len(sys.argv) >= 3:
-            chat_id = int(sys.argv[2])
-            query = " ".join(sys.argv[3:]) if len(sys.argv) > 3 else None
-            await message_handler.analyze_chat(chat_id, query)
-        elif command == "summarize-unread" and len(sys.argv) >= 3:
-            if sys.argv[2].lower() == "all":
-                # Summarize unread messages from all chats
-                print("\n=== Summarizing all unread messages across all chats ===\n")
-                summary = await message_handler.summarize_all_unread(client)
-                print("\n--- Complete Summary of All Unread Messages ---\n")
-                print(summary)
-            else:
-                # Summarize unread messages from a specific chat
-                chat_id = int(sys.argv[2])
-                summary = await message_handler.summarize_unread(client, chat_id)
-                print("\n--- Summary of Unread Messages ---\n")
-                print(summary)
-        elif command == "reply" and len(sys.argv) >= 3:
-            chat_id = int(sys.argv[2])
-            await message_handler.generate_reply(client, chat_id)
+        if argv[0] == "serve":
+            await service.serve(run_command, get_client)
         else:
-            print("Unknown command. Use one of:")
-            print("  fetch                       - Fetch all messages")
-            print("  fetch-unread                - Fetch only unread messages")
-            print("  analyze [chat_id] [query]   - Analyze messages from a chat")
-            print("  summarize-unread [chat_id]  - Summarize unread messages from a chat")
-            print("  summarize-unread all        - Summarize all unread messages across all chats")
-            print("  reply [chat_id]             - Generate and send a reply to a chat")
+            await run_command(argv)
     finally:
-        await client.disconnect()
+        for client in _clients.values():
+            await client.disconnect()
+        await llm.close_session()
+        cache_stats = llm_cache.stats()
+        if message_handler.DEBUG and cache_stats["hits"] + cache_stats["misses"]:
+            print(f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        pool_stats = llm.stats()
+        if message_handler.DEBUG and len(pool_stats["endpoints"]) > 1:
+            print(f"LLM queue: {pool_stats['queued']} requests, peak {pool_stats['waiting_peak']} waiting, "
+                  f"{pool_stats['mean_queue_wait']:.2f}s mean wait")
+            for endpoint in pool_stats["endpoints"]:
+                print(f"  {endpoint['url']}: {endpoint['requests']} requests, {endpoint['errors']} errors, "
+                      f"peak {endpoint['outstanding_peak']}/{endpoint['max_concurrency']} in flight, "
+                      f"{endpoint['mean_first_token']:.2f}s mean first token"
+                      f"{'' if endpoint['healthy'] else ', out of rotation'}")
+        llm_cache.close()
+        message_store.close_backend()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    started = time.perf_counter()
+    try:
+        asyncio.run(main())
+    finally:
+        command = sys.argv[1] if len(sys.argv) > 1 else ""
+        metrics.observe("command_seconds", time.perf_counter() - started, command=command)
+        metrics.export()
\ No newline at end of file
@@ -1,173 +1,137 @@
+import asyncio
 import os
-import sqlite3
 import time
 from datetime import datetime
-import json
-import requests
 import subprocess
 import tempfile
 
-from telethon import TelegramClient
+import dedup
+import dialog_cache
+import drafts
+import llm
+import metrics
+import priority
+import search
+import senders
+import summarizer
+from message_store import (
+    MESSAGE_HISTORY_LIMIT,
+    MessageWriter,
+    delete_draft,
+    get_recent_messages,
+    get_rolling_summary,
+    get_sync_info,
+    save_rolling_summary,
+    update_sync_info,
+)
+from rate_limit import RateLimiter
 
 # Telegram API credentials
 API_ID = "YOUR_API_ID"
 API_HASH = "YOUR_API_HASH"
 SESSION_NAME = "my_account"
-DB_DIR = "chat_databases"
 DEBUG = True
-MESSAGE_HISTORY_LIMIT = 120  # Keep this many messages per chat
-
-# Add these constants at the top with your other constants
-LLM_ENDPOINT = "http://localhost:8000/v1/chat/completions"
-LLM_MODEL = "tiiuae/Falcon3-1B-Instruct"
-LLM_TEMPERATURE = 0.0
-
-def get_db_path(chat_id):
-    """Returns the database file path for a given chat ID."""
-    return os.path.join(DB_DIR, f"chat_{chat_id}.db")
-
-def initialize_db(chat_id):
-    """Creates a new database for the chat if it doesn't exist."""
-    db_path = get_db_path(chat_id)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Add telegram_id to store actual Telegram message IDs
-    # Add message_date to track when messages were sent on Telegram
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER,
-        message_date TIMESTAMP,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        sender TEXT,
-        message TEXT
-    )""")
-    
-    # Create table to track last sync info
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS sync_info (
-        last_sync_time TIMESTAMP,
-        last_telegram_id INTEGER
-    )""")
-    
-    # Initialize sync info if empty
-    cursor.execute("SELECT COUNT(*) FROM sync_info")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute("INSERT INTO sync_info VALUES (?, ?)",
-                      (datetime.now().timestamp(), 0))
 
-    conn.commit()
-    conn.close()
+# Dialogs synced at once by fetch_messages, and Telegram requests per second
+# shared by all of them
+SYNC_CONCURRENCY = 4
+SYNC_RATE = 10.0
+FLOOD_WAIT_RETRIES = 3
 
-def store_message(chat_id, telegram_id, message_date, sender, message):
-    """Stores a new message in the database."""
-    db_path = get_db_path(chat_id)
+# Summaries generated at once by summarize_all_unread; match the inference
+# server's batch size
+LLM_CONCURRENCY = 4
 
-    if not os.path.exists(db_path):
-        initialize_db(chat_id)  # Create DB if missing
+# Rolling summaries are rebuilt from scratch after this many incremental
+# updates, or once they are this many seconds old
+ROLLING_REFRESH_EVERY = 10
+ROLLING_MAX_AGE = 7 * 24 * 3600
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Check if message already exists (avoid duplicates)
-    cursor.execute("SELECT COUNT(*) FROM messages WHERE telegram_id = ?", (telegram_id,))
-    if cursor.fetchone()[0] == 0:
-        cursor.execute(
-            "INSERT INTO messages (telegram_id, message_date, sender, message) VALUES (?, ?, ?, ?)", 
-            (telegram_id, message_date.timestamp(), sender, message)
-        )
-        conn.commit()
-    
-    conn.close()
+SYSTEM_PROMPT = "You are an intelligent message analysis assistant that helps users understand their chat history.\nYou either summarize messages or generate replies.\n When analyzing messages:\n- Focus on factual content and key information\n- Note who said what when it's relevant\n- Identify any tasks, deadlines, or commitments mentioned\n- Highlight questions that were asked but not answered\n\nBe concise but thorough in your responses. Present information in an organized manner with clear sections when appropriate.\n\nWhen generating replies:\n- Generate a natural and appropriate response based on the context of the conversation.\n- Ensure the reply is relevant to the most recent messages and has no extra text.\n\n974218208 is the chat ID of the user you are assisting."
 
-def update_sync_info(chat_id, last_telegram_id):
-    """Updates the sync information for a chat."""
-    db_path = get_db_path(chat_id)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "UPDATE sync_info SET last_sync_time = ?, last_telegram_id = ?",
-        (datetime.now().timestamp(), last_telegram_id)
-    )
-    
-    conn.commit()
-    conn.close()
+def _new_limiter(rate=None):
+    """Creates the token bucket shared by one run's Telegram requests."""
+    return RateLimiter(rate or SYNC_RATE, burst=max(1, SYNC_CONCURRENCY))
 
-def get_sync_info(chat_id):
-    """Gets the last sync information for a chat."""
-    db_path = get_db_path(chat_id)
-    
-    if not os.path.exists(db_path):
-        initialize_db(chat_id)
-        return 0
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT last_telegram_id FROM sync_info")
-    result = cursor.fetchone()
-    last_telegram_id = result[0] if result else 0
-    
-    conn.close()
-    return last_telegram_id
-
-def cleanup_old_messages(chat_id):
-    """Deletes messages beyond the history limit."""
-    db_path = get_db_path(chat_id)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Count total messages
-    cursor.execute("SELECT COUNT(*) FROM messages")
-    count = cursor.fetchone()[0]
-    
-    # Delete oldest messages if we have more than the limit
-    if count > MESSAGE_HISTORY_LIMIT:
-        to_delete = count - MESSAGE_HISTORY_LIMIT
-        if DEBUG: print(f"Deleting {to_delete} old messages from chat {chat_id}")
-        cursor.execute("""
-            DELETE FROM messages 
-            WHERE id IN (
-                SELECT id FROM messages 
-                ORDER BY message_date ASC 
-                LIMIT ?
-            )
-        """, (to_delete,))
-        conn.commit()
-        
-    conn.close()
+async def _sync_dialog(client, dialog, semaphore, limiter):
+    """Fetches new messages for one dialog; returns per-chat counters."""
+    from telethon.errors import FloodWaitError
 
-def get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT):
-    """Gets the most recent messages from a specific chat."""
-    db_path = get_db_path(chat_id)
-    
-    if not os.path.exists(db_path):
-        return []
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Get most recent messages first
-    cursor.execute("""
-        SELECT message_date, sender, message 
-        FROM messages 
-        ORDER BY message_date DESC
-        LIMIT ?
-    """, (limit,))
-    
-    messages = cursor.fetchall()
-    conn.close()
-    
-    # Return in chronological order (oldest first)
-    return list(reversed(messages))
+    chat_id = dialog.id
+    result = {"messages": 0, "written": 0, "skipped": 0, "updated": False, "unchanged": False}
+
+    async with semaphore:
+        # One connection per chat for the whole pass
+        with MessageWriter(chat_id) as writer:
+            # Get last known message ID for this chat
+            last_telegram_id = get_sync_info(chat_id, conn=writer.conn)
+            newest_telegram_id = last_telegram_id
+
+            # The snapshot already tells us the newest message; skip the RPC
+            # when we have it
+            if dialog.top_message_id and dialog.top_message_id <= last_telegram_id:
+                result["unchanged"] = True
+                return result
+
+            for attempt in range(FLOOD_WAIT_RETRIES + 1):
+                try:
+                    await limiter.acquire()
+                    fetched = 0
+                    # Counted per attempt; a retry fetches the same messages again
+                    result["messages"] = 0
+                    sender_batch = senders.SenderBatch()
+                    started = time.perf_counter()
+                    # Fetch new messages since last sync, newest first
+                    async for message in client.iter_messages(chat_id, min_id=last_telegram_id, limit=MESSAGE_HISTORY_LIMIT):
+                        fetched += 1
+                        # Telethon requests history in pages of 100
+                        if fetched % 100 == 0:
+                            await limiter.acquire()
+                        if message.text:
+                            writer.add(message.id, message.date, message.sender_id, message.text)
+                            sender_batch.add(message)
+                            result["messages"] += 1
+                        # Keep track of the newest message ID, text or not, so
+                        # the chat matches its top message next time
+                        newest_telegram_id = max(newest_telegram_id, message.id)
+                    metrics.observe("telegram_iter_messages_seconds", time.perf_counter() - started)
+                    break
+                except FloodWaitError as e:
+                    # Rows written so far are kept; the retry skips them as duplicates
+                    if attempt == FLOOD_WAIT_RETRIES:
+                        raise
+                    print(f"FloodWait of {e.seconds}s while syncing chat {chat_id}, backing off")
+                    metrics.inc("telegram_flood_waits_total")
+                    metrics.inc("telegram_flood_wait_seconds_total", e.seconds)
+                    limiter.pause(e.seconds)
+            writer.flush()
+            metrics.inc("messages_ingested_total", result["messages"])
+
+            # Names for prompts, refreshed once per SENDER_TTL
+            await senders.resolve(client, chat_id, sender_batch, conn=writer.conn, limiter=limiter)
+
+            # Update sync information with newest message ID
+            if newest_telegram_id > last_telegram_id:
+                if DEBUG:
+                    print(f"Updating sync info for chat {chat_id}: last_telegram_id = {newest_telegram_id}")
+                update_sync_info(chat_id, newest_telegram_id, conn=writer.conn)
+                result["updated"] = True
+
+    result["written"] = writer.written
+    result["skipped"] = writer.skipped
+    return result
 
 # Modify fetch_messages to accept an existing client
-async def fetch_messages(client=None):
-    """Fetches messages from all active chats and stores them."""
-    total_updates = 0
-    total_chats = 0
+async def fetch_messages(client=None, concurrency=None, rate=None, dialogs=None):
+    """Fetches messages from all active chats, or only ``dialogs``, and stores them.
+
+    Up to ``concurrency`` dialogs are synced at once and Telegram requests
+    share a token bucket of ``rate`` per second (SYNC_CONCURRENCY and
+    SYNC_RATE by default). Returns the run totals.
+    """
+    totals = {"chats": 0, "unchanged": 0, "failed": 0, "messages": 0, "written": 0, "skipped": 0, "updates": 0,
+              "updated_chats": [], "failed_chats": [], "elapsed": 0.0}
+    started = time.monotonic()
     
     # Check if we need to create a client or use the existing one
     if client is None:
@@ -178,6 +142,7 @@ async def fetch_messages(client=None):
             raise ValueError("API_ID and API_HASH must be set properly")
             
         # Create our own client since none was provided
+        from telethon import TelegramClient
         own_client = True
         client = TelegramClient(SESSION_NAME, api_id, API_HASH)
         await client.start()
@@ -186,50 +151,43 @@ async def fetch_messages(client=None):
         own_client = False
     
     try:
-        dialogs = await client.get_dialogs()  # Get all chats
+        if dialogs is None:
+            dialogs = await dialog_cache.get_snapshot(client)  # Get all chats
 
-        # Create the database directory if it doesn't exist
-        if not os.path.exists(DB_DIR):
-            os.makedirs(DB_DIR, exist_ok=True)
+        semaphore = asyncio.Semaphore(max(1, concurrency or SYNC_CONCURRENCY))
+        limiter = _new_limiter(rate)
 
-        for dialog in dialogs:
-            total_chats += 1
-            chat_id = dialog.id
-            
-            if not hasattr(dialog, 'title'):
-                print("No title available, skipping")
+        synced = list(dialogs)
+
+        results = await asyncio.gather(
+            *(_sync_dialog(client, dialog, semaphore, limiter) for dialog in synced),
+            return_exceptions=True
+        )
+
+        for dialog, result in zip(synced, results):
+            totals["chats"] += 1
+            if isinstance(result, BaseException):
+                # One broken chat should not lose the rest of the run
+                print(f"Failed to sync chat {dialog.id}: {result}")
+                totals["failed"] += 1
+                totals["failed_chats"].append(dialog.id)
                 continue
-            
-            # Get last known message ID for this chat
-            last_telegram_id = get_sync_info(chat_id)
-            
-            # Fetch new messages since last sync
-            newest_telegram_id = last_telegram_id
-            message_count = 0
-            
-            # Use reverse=True to get newest messages first
-            async for message in client.iter_messages(chat_id, min_id=last_telegram_id, limit=MESSAGE_HISTORY_LIMIT):
-                if message.text:
-                    sender = message.sender_id or "Unknown"
-                    store_message(chat_id, message.id, message.date, sender, message.text)
-                    message_count += 1
-                    # Keep track of the newest message ID
-                    newest_telegram_id = max(newest_telegram_id, message.id)
-            
-            # Update sync information with newest message ID
-            if newest_telegram_id > last_telegram_id:
-                if DEBUG:
-                    print(f"Updating sync info for chat {chat_id}: last_telegram_id = {newest_telegram_id}")
-                update_sync_info(chat_id, newest_telegram_id)
-                total_updates += 1
-            
-            # Clean up old messages to maintain history limit
-            cleanup_old_messages(chat_id)
-            
-        if DEBUG:
-            print(f"Total chats processed: {total_chats}")
+            totals["messages"] += result["messages"]
+            totals["written"] += result["written"]
+            totals["skipped"] += result["skipped"]
+            totals["updates"] += result["updated"]
+            if result["updated"]:
+                totals["updated_chats"].append(dialog.id)
+            totals["unchanged"] += result["unchanged"]
+
+        totals["elapsed"] = time.monotonic() - started
+        print(f"Synced {totals['messages']} messages from {totals['chats']} chats in {totals['elapsed']:.1f}s")
         if DEBUG:
-            print(f"Total updates made: {total_updates}")
+            print(f"Total updates made: {totals['updates']}, chats already up to date: {totals['unchanged']}")
+            print(f"Rows written: {totals['written']}, skipped as duplicates: {totals['skipped']}")
+            if limiter.waited:
+                print(f"Waited {limiter.waited:.0f}s on FloodWait")
+        return totals
             
     finally:
         # Only disconnect if we created our own client
@@ -240,6 +198,8 @@ async def fetch_unread_messages(client=None):
     """Fetches only unread messages from all active chats and stores them."""
     total_updates = 0
     total_chats = 0
+    total_written = 0
+    total_skipped = 0
     
     # Check if we need to create a client or use the existing one
     if client is None:
@@ -250,6 +210,7 @@ async def fetch_unread_messages(client=None):
             raise ValueError("API_ID and API_HASH must be set properly")
             
         # Create our own client since none was provided
+        from telethon import TelegramClient
         own_client = True
         client = TelegramClient(SESSION_NAME, api_id, API_HASH)
         await client.start()
@@ -258,64 +219,73 @@ async def fetch_unread_messages(client=None):
         own_client = False
     
     try:
-        dialogs = await client.get_dialogs()  # Get all chats
-
-        # Create the database directory if it doesn't exist
-        if not os.path.exists(DB_DIR):
-            os.makedirs(DB_DIR, exist_ok=True)
+        snapshot = await dialog_cache.get_snapshot(client)  # Get all chats
 
-        for dialog in dialogs:
-            if dialog.unread_count == 0:
-                continue  # Skip chats with no unread messages
-                
+        # Skip chats with no unread messages
+        for dialog in snapshot.with_unread():
             total_chats += 1
             chat_id = dialog.id
-            
-            if not hasattr(dialog, 'title'):
-                print("No title available, skipping")
-                continue
                 
             print(f"Fetching {dialog.unread_count} unread messages from: {dialog.title} ({chat_id})")
             
-            # Fetch only unread messages
-            message_count = 0
-            newest_telegram_id = get_sync_info(chat_id)
-            
-            # Get unread messages
-            async for message in client.iter_messages(chat_id, limit=dialog.unread_count):
-                if message.text:
-                    sender = message.sender_id or "Unknown"
-                    store_message(chat_id, message.id, message.date, sender, message.text)
-                    message_count += 1
-                    # Keep track of the newest message ID
-                    newest_telegram_id = max(newest_telegram_id, message.id)
-            
-            # Update sync information with newest message ID
-            if message_count > 0:
-                update_sync_info(chat_id, newest_telegram_id)
-                total_updates += 1
+            with MessageWriter(chat_id) as writer:
+                # Fetch only unread messages
+                message_count = 0
+                newest_telegram_id = get_sync_info(chat_id, conn=writer.conn)
+                
+                # Get unread messages
+                sender_batch = senders.SenderBatch()
+                started = time.perf_counter()
+                async for message in client.iter_messages(chat_id, limit=dialog.unread_count):
+                    if message.text:
+                        writer.add(message.id, message.date, message.sender_id, message.text)
+                        sender_batch.add(message)
+                        message_count += 1
+                        # Keep track of the newest message ID
+                        newest_telegram_id = max(newest_telegram_id, message.id)
+                metrics.observe("telegram_iter_messages_seconds", time.perf_counter() - started)
+                writer.flush()
+                metrics.inc("messages_ingested_total", message_count)
+                await senders.resolve(client, chat_id, sender_batch, conn=writer.conn)
+                
+                # Update sync information with newest message ID
+                if message_count > 0:
+                    update_sync_info(chat_id, newest_telegram_id, conn=writer.conn)
+                    total_updates += 1
+
+            total_written += writer.written
+            total_skipped += writer.skipped
             
             # Mark messages as read
-            await client.send_read_acknowledge(dialog)
+            await client.send_read_acknowledge(dialog.entity)
+            snapshot.mark_read(chat_id)
             
         if DEBUG:
             print(f"Total chats with unread messages: {total_chats}")
             print(f"Total updates made: {total_updates}")
+            print(f"Rows written: {total_written}, skipped as duplicates: {total_skipped}")
             
     finally:
         # Only disconnect if we created our own client
         if own_client:
             await client.disconnect()
 
-async def get_unread_messages_for_chat(client, chat_id):
-    """Gets only the unread messages for a specific chat."""
-    dialog = None
-    
-    # First find the dialog for this chat_id
-    async for d in client.iter_dialogs():
-        if d.id == chat_id:
-            dialog = d
-            break
+def format_chat_context(messages):
+    """Formats (timestamp, sender, text, ...) rows as prompt lines."""
+    return "\n".join([
+        f"[{datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M')}] {row[1]}: {row[2]}" 
+        for row in messages
+    ])
+
+async def get_unread_messages_for_chat(client, chat_id, dialog=None):
+    """Gets only the unread messages for a specific chat.
+
+    Pass ``dialog`` when the caller already holds the chat's DialogInfo.
+    """
+    if dialog is None:
+        # Look the chat up in this run's dialog snapshot
+        snapshot = await dialog_cache.get_snapshot(client)
+        dialog = snapshot.get(chat_id)
             
     if not dialog or dialog.unread_count == 0:
         return []
@@ -323,18 +293,76 @@ async def get_unread_messages_for_chat(client, chat_id):
     print(f"Found {dialog.unread_count} unread messages in {dialog.title}")
     
     messages = []
+    sender_batch = senders.SenderBatch()
+    started = time.perf_counter()
     # Fetch unread messages
     async for message in client.iter_messages(chat_id, limit=dialog.unread_count):
         if message.text:
-            sender = message.sender_id or "Unknown"
             # Instead of storing, just collect in memory
-            messages.append((message.date.timestamp(), sender, message.text, message.id))
-            
+            messages.append((message.date.timestamp(), message.sender_id, message.text, message.id))
+            sender_batch.add(message)
+    metrics.observe("telegram_iter_messages_seconds", time.perf_counter() - started)
+
+    # Show sender names rather than ids in prompts
+    names = await senders.resolve(client, chat_id, sender_batch)
+
     # Return messages in chronological order (oldest first)
-    return sorted(messages, key=lambda x: x[0])[:MESSAGE_HISTORY_LIMIT]
+    return senders.name_rows(sorted(messages, key=lambda x: x[0])[:MESSAGE_HISTORY_LIMIT], names)
+
+async def summarize_incrementally(chat_id, chat_title, messages, full_prompt, stream_output=True):
+    """Updates the stored rolling summary of a chat; raises llm.LLMError.
+
+    Only messages newer than the stored summary are sent, together with
+    that summary, so cost follows new traffic. Every ROLLING_REFRESH_EVERY
+    updates, or once the summary is older than ROLLING_MAX_AGE seconds,
+    ``full_prompt`` rebuilds it from scratch to limit drift.
+    """
+    previous = get_rolling_summary(chat_id)
+    newest_telegram_id = max(row[3] for row in messages)
+
+    if previous is not None:
+        new_messages = [row for row in messages if row[3] > previous["last_telegram_id"]]
+        if not new_messages:
+            if DEBUG: print(f"Summary of '{chat_title}' is already up to date")
+            return previous["summary"]
+
+        fresh = time.time() - (previous["updated_at"] or 0) < ROLLING_MAX_AGE
+        if previous["increments"] < ROLLING_REFRESH_EVERY and fresh:
+            chat_context = format_chat_context(new_messages)
+            prompt = f"Here is the summary of '{chat_title}' so far:\n\n{previous['summary']}\n\n"
+            prompt += f"Here are {len(new_messages)} new messages since then:\n\n{chat_context}\n\n"
+            prompt += "Please update the summary with the new messages. Keep it concise, drop points that no longer matter, and highlight any new important information or action items."
+
+            summary = await generate(prompt, stream_output=stream_output)
+            save_rolling_summary(chat_id, summary, max(newest_telegram_id, previous["last_telegram_id"]),
+                                 previous["increments"] + 1)
+            return summary
+
+    summary = await generate(full_prompt, stream_output=stream_output)
+    save_rolling_summary(chat_id, summary, newest_telegram_id)
+    return summary
+
 async def summarize_unread(client, chat_id):
     """Summarizes only the unread messages from a specific chat."""
-    unread_messages = await get_unread_messages_for_chat(client, chat_id)
+    snapshot = await dialog_cache.get_snapshot(client)
+    dialog = snapshot.get(chat_id)
+
+    if dialog and dialog.unread_count > summarizer.WINDOW_MESSAGES:
+        # Too many for one prompt; cover the whole backlog with map-reduce
+        print(f"\n--- Summarizing {dialog.unread_count} unread messages in parts ---\n")
+        try:
+            summary, _ = await summarizer.summarize_backlog(client, dialog)
+        except llm.LLMError as e:
+            error_msg = f"Error processing messages: {str(e)}"
+            print(error_msg)
+            return error_msg
+        # A whole backlog counts as a full refresh of the rolling summary
+        save_rolling_summary(chat_id, summary, dialog.top_message_id)
+        await client.send_read_acknowledge(dialog.entity)
+        snapshot.mark_read(chat_id)
+        return summary
+
+    unread_messages = await get_unread_messages_for_chat(client, chat_id, dialog=dialog)
     
     
     if not unread_messages:
@@ -342,10 +370,7 @@ async def summarize_unread(client, chat_id):
         return "No unread messages to summarize."
     
     # Format the chat history for context
-    chat_context = "\n".join([
-        f"[{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')}] {sender}: {msg}" 
-        for ts, sender, msg, _ in unread_messages
-    ])
+    chat_context = format_chat_context(unread_messages)
     
     # Prepare the full prompt
     prompt = f"Here are the unread messages that need summarizing:\n\n{chat_context}\n\n"
@@ -353,39 +378,56 @@ async def summarize_unread(client, chat_id):
     
     print("\n--- Generating summary of unread messages ---\n")
     
-    # Use the LLM to generate a summary
-    summary = await process_with_llm_async(prompt)
+    # Use the LLM to update the chat's rolling summary
+    try:
+        summary = await summarize_incrementally(chat_id, dialog.title if dialog else f"Chat {chat_id}", unread_messages, prompt)
+    except llm.LLMError as e:
+        error_msg = f"Error processing messages: {str(e)}"
+        print(error_msg)
+        return error_msg
     
     # Now mark messages as read
     await client.send_read_acknowledge(chat_id)
+    snapshot.mark_read(chat_id)
     
     return summary
 
-async def generate_reply(client, chat_id):
-    """Generates a reply based on recent messages and allows editing before sending."""
-    # Get recent messages for context
-    recent_messages = get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT)
-    
-    if not recent_messages:
-        return "No messages found to generate a reply for."
-    
+def reply_prompt(recent_messages):
+    """Returns the prompt asking for a reply to the recent messages of a chat."""
     # Format the chat history for context
-    chat_context = "\n".join([
-        f"[{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')}] {sender}: {msg}" 
-        for ts, sender, msg in recent_messages
-    ])
-    
-    # Prepare the prompt for reply generation
+    chat_context = format_chat_context(recent_messages)
     prompt = f"Here are the recent messages in this conversation:\n\n{chat_context}\n\n"
     prompt += "Please generate an appropriate reply to continue this conversation naturally."
-    
-    print("\n--- Generating suggested reply ---\n")
-    
-    # Use the LLM to generate a reply
-    suggested_reply = await process_with_llm_async(prompt)
+    return prompt
+
+async def generate_reply(client, chat_id, draft_only=False):
+    """Generates a reply based on recent messages and allows editing before sending.
+
+    A draft precomputed since the chat's newest message is used as is;
+    otherwise the reply is generated now. With ``draft_only`` the
+    suggestion is only shown, so it works offline from the local store and
+    ``client`` may be None.
+    """
+    draft = drafts.fresh_draft(chat_id)
+    if draft is not None:
+        if DEBUG: print(f"Using the draft written {time.time() - draft['created_at']:.0f}s ago")
+        suggested_reply = draft["draft"]
+    else:
+        # Get recent messages for context
+        recent_messages = get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT)
+
+        if not recent_messages:
+            return "No messages found to generate a reply for."
+
+        print("\n--- Generating suggested reply ---\n")
+
+        # Use the LLM to generate a reply
+        suggested_reply = await process_with_llm_async(reply_prompt(recent_messages))
     
     print("\n--- Suggested reply ---\n")
     print(suggested_reply)
+    if draft_only:
+        return suggested_reply
     print("\n--- You can now edit this reply. Press Ctrl+D when finished ---\n")
     
     # Save suggested reply to a temporary file
@@ -410,6 +452,8 @@ async def generate_reply(client, chat_id):
         if confirm.lower() == 'y':
             # Send the message
             await client.send_message(chat_id, edited_reply)
+            # The draft is answered; the next one waits for their reply
+            delete_draft(chat_id)
             print("Reply sent successfully!")
             return edited_reply
         else:
@@ -420,126 +464,275 @@ async def generate_reply(client, chat_id):
         if os.path.exists(tmp_path):
             os.unlink(tmp_path)
 
-async def process_with_llm_async(prompt):
+async def generate(prompt, stream_output=True):
+    """Runs the prompt through the LLM and returns the text; raises llm.LLMError.
+
+    Tokens are printed as they arrive unless ``stream_output`` is False.
+    """
+    on_token = None
+    if stream_output:
+        # Print content directly without newlines to simulate streaming
+        on_token = lambda token: print(token, end='', flush=True)
+
+    result = await llm.complete(prompt, SYSTEM_PROMPT, on_token=on_token)
+
+    if stream_output:
+        # Add a final newline
+        print("\n")
+    if DEBUG and result.cached:
+        print("LLM: answered from cache")
+    elif DEBUG:
+        print(f"LLM: {result.tokens} tokens, first token after {result.time_to_first_token:.2f}s, "
+              f"{result.tokens_per_second:.1f} tokens/s, {result.total_time:.2f}s total")
+    return result.text
+
+async def process_with_llm_async(prompt, stream_output=True):
     """Async version of process_with_llm that works with a direct prompt."""
     # Ensure prompt is never None
     if prompt is None:
         prompt = "Please analyze the recent messages."
-    
-    # Prepare the curl command for streaming
-    curl_cmd = [
-        "curl", "-sN", LLM_ENDPOINT,
-        "-H", "Content-Type: application/json",
-        "-d", json.dumps({
-            "model": LLM_MODEL,
-            "stream": True,
-            "messages": [
-                {"role": "system", "content": "You are an intelligent message analysis assistant that helps users understand their chat history.\nYou either summarize messages or generate replies.\n When analyzing messages:\n- Focus on factual content and key information\n- Note who said what when it's relevant\n- Identify any tasks, deadlines, or commitments mentioned\n- Highlight questions that were asked but not answered\n\nBe concise but thorough in your responses. Present information in an organized manner with clear sections when appropriate.\n\nWhen generating replies:\n- Generate a natural and appropriate response based on the context of the conversation.\n- Ensure the reply is relevant to the most recent messages and has no extra text.\n\n974218208 is the chat ID of the user you are assisting."},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": LLM_TEMPERATURE
-        })
-    ]
-    
-    # Instead of returning the raw response, we'll process it line by line and collect the content
-    collected_response = ""
-    
+
     try:
-        # Use Popen to stream the output in real-time
-        process = subprocess.Popen(curl_cmd, stdout=subprocess.PIPE, text=True)
-        
-        for line in process.stdout:
-            line = line.strip()
-            if not line or line == "data: [DONE]":
-                continue
-                
-            if line.startswith("data:"):
-                try:
-                    # Extract just the JSON part after "data: "
-                    json_data = json.loads(line[5:].strip())
-                    
-                    if 'choices' in json_data and json_data['choices']:
-                        content = json_data['choices'][0].get('delta', {}).get('content', '')
-                        if content:
-                            # Print content directly without newlines to simulate streaming
-                            print(content, end='', flush=True)
-                            collected_response += content
-                except json.JSONDecodeError:
-                    pass
-                except Exception as e:
-                    print(f"Error parsing JSON: {str(e)}, line: {line}")
-        
-        # Add a final newline
-        print("\n")
-        return collected_response
-        
-    except Exception as e:
+        return await generate(prompt, stream_output)
+    except llm.LLMError as e:
         error_msg = f"Error processing messages: {str(e)}"
         print(error_msg)
         return error_msg
 
-async def summarize_all_unread(client):
-    """Summarizes unread messages from all chats."""
+async def summarize_all_unread(client, concurrency=None, time_budget=None, token_budget=None, on_result=None):
+    """Summarizes unread messages from all chats, most important first.
+
+    Chats are ranked by priority.score. Within the token budget their
+    unread messages are prefetched, then up to ``concurrency`` summaries
+    are generated at once, by default LLM_CONCURRENCY or what the LLM
+    endpoints can run together, if more. Once ``time_budget`` seconds have
+    passed no new summary is started. Chats left over are only listed with
+    their counts. Messages repeated across chats are collapsed before any
+    prompt is built, and only chats whose summary succeeded are marked as
+    read; a chat left with nothing but repeats waits for the chats that
+    kept them.
+
+    Each part of the report is passed to ``on_result`` as soon as it is
+    ready; the whole report is returned in priority order.
+    """
+    started = time.monotonic()
+    concurrency = max(1, concurrency or max(LLM_CONCURRENCY, llm.capacity()))
+    time_budget = priority.SUMMARY_TIME_BUDGET if time_budget is None else time_budget
+
+    def report(text):
+        if on_result:
+            on_result(text)
+        return text
+
     print("Checking all chats for unread messages...")
     
     # Get all dialogs with unread messages
-    dialogs_with_unread = []
-    async for dialog in client.iter_dialogs():
-        if dialog.unread_count > 0:
-            dialogs_with_unread.append(dialog)
+    snapshot = await dialog_cache.get_snapshot(client)
+    dialogs_with_unread = snapshot.with_unread()
     
     if not dialogs_with_unread:
-        return "No unread messages in any chats."
+        return report("No unread messages in any chats.")
     
     print(f"Found {len(dialogs_with_unread)} chats with unread messages.")
-    
-    # Generate summaries for each chat with unread messages
-    all_summaries = []
-    
-    for dialog in dialogs_with_unread:
-        chat_id = dialog.id
-        chat_title = dialog.title if hasattr(dialog, 'title') else f"Chat {chat_id}"
-        
-        print(f"\nProcessing: {chat_title} ({dialog.unread_count} unread messages)")
-        
-        # Get unread messages for this chat
-        unread_messages = await get_unread_messages_for_chat(client, chat_id)
-        
-        if not unread_messages:
-            continue
-        
+    dialogs_with_unread, skipped = priority.plan(dialogs_with_unread, token_budget)
+    ranked = dialogs_with_unread + skipped
+    if skipped:
+        print(f"Summarizing the {len(dialogs_with_unread)} most important within the token budget")
+    skipped_ids = {dialog.id for dialog in skipped}
+
+    # Prefetch unread messages for every chat, sharing the sync rate limit
+    fetch_semaphore = asyncio.Semaphore(max(1, SYNC_CONCURRENCY))
+    limiter = _new_limiter()
+
+    async def prefetch(dialog):
+        if dialog.unread_count > summarizer.WINDOW_MESSAGES:
+            return None  # Streamed window by window when summarized
+        async with fetch_semaphore:
+            await limiter.acquire()
+            return await get_unread_messages_for_chat(client, dialog.id, dialog=dialog)
+
+    prefetched = await asyncio.gather(
+        *(prefetch(dialog) for dialog in dialogs_with_unread),
+        return_exceptions=True
+    )
+
+    # Generate summaries with bounded concurrency; streaming tokens from
+    # several chats at once would interleave, so only print them when serial
+    llm_semaphore = asyncio.Semaphore(concurrency)
+    stream_output = concurrency == 1
+    done = 0
+    failed = 0
+
+    begun = 0
+
+    def within_time_budget():
+        # The most important chat is always summarized
+        nonlocal begun
+        if begun and time_budget and time.monotonic() - started >= time_budget:
+            return False
+        begun += 1
+        return True
+
+    async def summarize_messages(chat_id, chat_title, unread_messages):
         # Format the chat context
-        chat_context = "\n".join([
-            f"[{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')}] {sender}: {msg}" 
-            for ts, sender, msg, _ in unread_messages
-        ])
+        chat_context = format_chat_context(unread_messages)
         
         # Prepare the prompt for this chat
         prompt = f"Here are {len(unread_messages)} unread messages from '{chat_title}':\n\n{chat_context}\n\n"
         prompt += "Please provide a brief but informative summary of these messages, highlighting important points."
-        
-        print(f"Generating summary for '{chat_title}'...")
-        
-        # Get summary for this chat
-        chat_summary = await process_with_llm_async(prompt)
-        
-        # Mark messages as read
-        await client.send_read_acknowledge(chat_id)
-        
-        # Add to compiled summaries
-        all_summaries.append(f"## {chat_title} ({dialog.unread_count} messages)\n\n{chat_summary}\n")
+
+        async with llm_semaphore:
+            # Checked once this chat's turn comes
+            if not within_time_budget():
+                return None
+            print(f"Generating summary for '{chat_title}'...")
+            return await summarize_incrementally(chat_id, chat_title, unread_messages, prompt, stream_output=stream_output)
+
+    async def summarize(dialog, unread_messages):
+        try:
+            return await summarize_chat(dialog, unread_messages)
+        finally:
+            # Anything that did not finish counts as failed for the chats
+            # waiting on this one
+            if not outcomes[dialog.id].done():
+                outcomes[dialog.id].set_result("failed")
+
+    async def summarize_chat(dialog, unread_messages):
+        nonlocal done, failed
+        chat_id = dialog.id
+        chat_title = dialog.title
+        unread_count = dialog.unread_count  # Cleared once the chat is marked read
+
+        try:
+            if unread_messages == []:
+                # Every message was a repeat kept under other chats, so this
+                # one is only covered once their summaries exist
+                kept = set(await asyncio.gather(*(outcomes[keeper] for keeper in keepers[chat_id])))
+                if "failed" in kept:
+                    raise RuntimeError("the chats its messages were repeated in could not be summarized")
+                if "skipped" in kept:
+                    outcomes[chat_id].set_result("skipped")
+                    skipped_ids.add(chat_id)
+                    return None
+                chat_summary = "Only repeats of messages summarized in other chats."
+            elif unread_messages is None:
+                # Large backlog: map-reduce, sharing the LLM slots with other chats
+                async with llm_semaphore:
+                    # Wait for a turn so the budget is checked when it comes
+                    pass
+                if not within_time_budget():
+                    outcomes[chat_id].set_result("skipped")
+                    skipped_ids.add(chat_id)
+                    return None
+                print(f"Summarizing {dialog.unread_count} messages from '{chat_title}' in parts...")
+                chat_summary, _ = await summarizer.summarize_backlog(client, dialog, semaphore=llm_semaphore)
+                save_rolling_summary(chat_id, chat_summary, dialog.top_message_id)
+            else:
+                chat_summary = await summarize_messages(chat_id, chat_title, unread_messages)
+                if chat_summary is None:
+                    outcomes[chat_id].set_result("skipped")
+                    skipped_ids.add(chat_id)
+                    return None
+        except Exception as e:
+            # Failed chats stay unread
+            outcomes[chat_id].set_result("failed")
+            failed += 1
+            return report(f"## {chat_title} ({unread_count} messages)\n\nSummary failed: {e}\n")
+
+        outcomes[chat_id].set_result("done")
+
+        # Mark messages as read only once the summary exists
+        try:
+            await client.send_read_acknowledge(dialog.entity)
+            snapshot.mark_read(chat_id)
+        except Exception as e:
+            print(f"Could not mark '{chat_title}' as read: {e}")
+
+        done += 1
+        print(f"Finished '{chat_title}' ({done}/{len(jobs)})")
+        return report(f"## {chat_title} ({unread_count} messages)\n\n{chat_summary}\n")
+
+    jobs = []
+    for dialog, unread_messages in zip(dialogs_with_unread, prefetched):
+        if isinstance(unread_messages, BaseException):
+            print(f"Could not fetch unread messages for chat {dialog.id}: {unread_messages}")
+            continue
+        if unread_messages or unread_messages is None:
+            jobs.append((dialog, unread_messages))
+
+    # Announcements forwarded into many chats are summarized once, under
+    # the first chat they appear in
+    prefetched_jobs = [i for i, (_, unread_messages) in enumerate(jobs) if unread_messages]
+    collapsed_messages, removed, saved_tokens, kept_in = dedup.collapse_repeats(
+        [(jobs[i][0].title, jobs[i][1]) for i in prefetched_jobs]
+    )
+    keepers = {}
+    for i, unread_messages, kept in zip(prefetched_jobs, collapsed_messages, kept_in):
+        jobs[i] = (jobs[i][0], unread_messages)
+        keepers[jobs[i][0].id] = [jobs[prefetched_jobs[k]][0].id for k in kept]
+    # "done", "skipped" or "failed" for each chat, once known
+    loop = asyncio.get_running_loop()
+    outcomes = {dialog.id: loop.create_future() for dialog, _ in jobs}
+    metrics.inc("dedup_messages_collapsed_total", removed)
+    metrics.inc("dedup_tokens_saved_total", saved_tokens)
+    if removed:
+        print(f"Collapsed {removed} repeated messages (~{saved_tokens} tokens saved)")
+
+    # Started in priority order, which the LLM semaphore keeps
+    results = await asyncio.gather(
+        *(summarize(dialog, unread_messages) for dialog, unread_messages in jobs),
+        return_exceptions=True
+    )
+
+    all_summaries = []
+    for (dialog, _), result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            all_summaries.append(report(f"## {dialog.title} ({dialog.unread_count} messages)\n\nSummary failed: {result}\n"))
+        elif result is not None:
+            all_summaries.append(result)
+
+    if failed:
+        print(f"{failed} of {len(jobs)} summaries failed; those chats were left unread.")
+
+    # Whatever the budget left out, most important first
+    left_out = [dialog for dialog in ranked if dialog.id in skipped_ids]
+    if left_out:
+        print(f"Budget reached; {len(left_out)} chats were not summarized.")
+        all_summaries.append(report(f"## Not summarized ({len(left_out)} chats)\n\n{priority.format_listing(left_out)}\n"))
     
     # Combine all summaries
     return "\n\n".join(all_summaries)
 
-# Example function to use in your main script
 async def analyze_chat(chat_id, query=None):
-    """Fetches messages and analyzes them with the LLM."""
-    # Pass the existing client instead of creating a new one
-    #await fetch_messages(client)
-    # Then process with LLM
-    result = await process_with_llm_async(query)
+    """Answers a question about a chat from its most relevant stored messages.
+
+    Messages are picked from the full-text index by BM25 rank, with their
+    neighbours for context. Without a query, or when nothing matches, the
+    most recent messages are analyzed instead.
+    """
+    rows = search.retrieve_context(chat_id, query) if query else []
+
+    if rows:
+        print(f"Found {sum(row is not None for row in rows)} relevant messages")
+        chat_context = "\n".join("..." if row is None else format_chat_context([row]) for row in rows)
+        prompt = f"Here are the messages from this chat that are most relevant to the question, with surrounding context:\n\n{chat_context}\n\n"
+        prompt += f"Question: {query}\n\nPlease answer the question using these messages."
+    else:
+        recent_messages = get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT)
+        if not recent_messages:
+            print(f"No stored messages for chat {chat_id}")
+            return None
+        if query:
+            print("No messages matched the query; using the most recent messages")
+        chat_context = format_chat_context(recent_messages)
+        prompt = f"Here are the recent messages in this conversation:\n\n{chat_context}\n\n"
+        if query:
+            prompt += f"Question: {query}\n\nPlease answer the question using these messages."
+        else:
+            prompt += "Please analyze these messages, highlighting key information, tasks and open questions."
+
+    return await process_with_llm_async(prompt)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(fetch_messages())
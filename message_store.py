@@ -0,0 +1,761 @@
+import contextvars
+import os
+import glob
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
+
+DB_DIR = "chat_databases"
+DEBUG = True
+MESSAGE_HISTORY_LIMIT = 120  # Default retention: keep this many messages per chat
+RETENTION_MAX_AGE = 0  # Default retention: seconds to keep messages for, 0 for no limit
+WRITE_BATCH_SIZE = 500  # Rows per insert transaction during a sync pass
+
+# "per-chat" keeps one chat_{id}.db file per chat, "consolidated" keeps
+# every chat in a single WAL-mode database
+STORAGE_BACKEND = "per-chat"
+CONSOLIDATED_DB_NAME = "messages.db"
+READER_POOL_SIZE = 4
+
+SCHEMA_VERSION = 8
+
+# Resolves the sender of messages aliased "m" joined to senders aliased "s"
+SENDER_NAME_SQL = "COALESCE(s.display_name, CAST(m.sender_id AS TEXT), m.sender, 'Unknown')"
+
+# Message ids of private chats and small groups are numbered per account,
+# so every account but the first (index 0) stores them under its own ids:
+# the chat id moved away from zero by ACCOUNT_ID_STRIDE times the account
+# index. Channels and supergroups have shared ids and are stored once.
+ACCOUNT_ID_STRIDE = 1 << 52
+CHANNEL_ID_LIMIT = -1000000000000  # Marked channel ids are this or lower
+
+# Index of the account the current task works for
+current_account = contextvars.ContextVar("current_account", default=0)
+
+_backend = None
+
+def is_channel_id(chat_id):
+    return -ACCOUNT_ID_STRIDE < chat_id <= CHANNEL_ID_LIMIT
+
+def store_chat_id(chat_id):
+    """Returns the id a Telegram chat of the current account is stored under.
+
+    Ids that are already store ids are returned unchanged.
+    """
+    account = current_account.get()
+    if not account or chat_id is None or is_channel_id(chat_id) or abs(chat_id) >= ACCOUNT_ID_STRIDE:
+        return chat_id
+    offset = account * ACCOUNT_ID_STRIDE
+    return chat_id + offset if chat_id > 0 else chat_id - offset
+
+def _account_chats_sql():
+    """Returns a condition on chat_id matching the current account's own chats."""
+    account = current_account.get()
+    if not account:
+        return f"chat_id > {CHANNEL_ID_LIMIT} AND chat_id < {ACCOUNT_ID_STRIDE}"
+    low, high = account * ACCOUNT_ID_STRIDE, (account + 1) * ACCOUNT_ID_STRIDE
+    return f"(chat_id >= {low} AND chat_id < {high}) OR (chat_id <= {-low} AND chat_id > {-high})"
+
+def get_db_path(chat_id):
+    """Returns the database file path for a given chat ID."""
+    chat_id = store_chat_id(chat_id)
+    return os.path.join(DB_DIR, f"chat_{chat_id}.db")
+
+def get_consolidated_path():
+    """Returns the path of the single database used by the consolidated backend."""
+    return os.path.join(DB_DIR, CONSOLIDATED_DB_NAME)
+
+def ensure_schema(conn, chat_id=None):
+    """Creates or upgrades the tables of an open database.
+
+    ``chat_id`` is the owner of a per-chat file; the consolidated database
+    passes None. Upgrades run once per database, tracked in user_version.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    if version == 0:
+        # Lets maintenance return freed pages a few at a time; only takes
+        # effect before the first table is created
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    if version < 1:
+        # Add telegram_id to store actual Telegram message IDs
+        # Add message_date to track when messages were sent on Telegram
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            message_date TIMESTAMP,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sender TEXT,
+            message TEXT
+        )""")
+
+        # Create table to track last sync info
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_info (
+            last_sync_time TIMESTAMP,
+            last_telegram_id INTEGER
+        )""")
+
+        # Older databases may hold duplicates from before the unique index existed
+        cursor.execute("""
+            DELETE FROM messages
+            WHERE telegram_id IS NOT NULL AND id NOT IN (
+                SELECT MIN(id) FROM messages GROUP BY telegram_id
+            )
+        """)
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_telegram_id ON messages (telegram_id)"
+        )
+
+    if version < 2:
+        # Every row carries its chat so both backends share the same queries
+        cursor.execute("ALTER TABLE messages ADD COLUMN chat_id INTEGER")
+        cursor.execute("ALTER TABLE sync_info ADD COLUMN chat_id INTEGER")
+        if chat_id is not None:
+            cursor.execute("UPDATE messages SET chat_id = ?", (chat_id,))
+            cursor.execute("UPDATE sync_info SET chat_id = ?", (chat_id,))
+        cursor.execute("DROP INDEX IF EXISTS idx_messages_telegram_id")
+        cursor.execute(
+            "CREATE UNIQUE INDEX idx_messages_chat_telegram ON messages (chat_id, telegram_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX idx_messages_chat_date ON messages (chat_id, message_date)"
+        )
+        cursor.execute("CREATE UNIQUE INDEX idx_sync_info_chat ON sync_info (chat_id)")
+
+    if version < 3:
+        # Rolling summary per chat and the newest message it covers
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS summaries (
+            chat_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_telegram_id INTEGER,
+            increments INTEGER DEFAULT 0,
+            updated_at TIMESTAMP
+        )""")
+
+    if version < 4:
+        # Full-text index over message text, kept in sync by triggers
+        try:
+            cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message, content='messages', content_rowid='id'
+            )""")
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5; analyze falls back to recent messages
+            print(f"Full-text search unavailable: {e}")
+        else:
+            cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+            END""")
+            cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            END""")
+            cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+            END""")
+            # Index the messages stored before the index existed
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    if version < 5:
+        # Per-chat retention; chats without a row use the defaults above
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            chat_id INTEGER PRIMARY KEY,
+            max_messages INTEGER,
+            max_age REAL,
+            keep_all INTEGER DEFAULT 0
+        )""")
+
+    if version < 6:
+        # Senders are stored once and referenced by id; the sender text
+        # column only keeps values that were never an id, like "Unknown"
+        cursor.execute("ALTER TABLE messages ADD COLUMN sender_id INTEGER")
+        cursor.execute("""
+            UPDATE messages SET sender_id = CAST(sender AS INTEGER), sender = NULL
+            WHERE sender GLOB '[0-9]*' OR sender GLOB '-[0-9]*'
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS senders (
+            id INTEGER PRIMARY KEY,
+            display_name TEXT,
+            username TEXT,
+            refreshed_at TIMESTAMP
+        )""")
+
+    if version < 7:
+        # Backfill progress: the oldest message stored by walking history
+        # backward, and whether that walk reached the start of the chat
+        cursor.execute("ALTER TABLE sync_info ADD COLUMN backfill_oldest_id INTEGER")
+        cursor.execute("ALTER TABLE sync_info ADD COLUMN backfill_done INTEGER DEFAULT 0")
+
+    if version < 8:
+        # Reply drafts generated ahead of time, and the newest message each
+        # was based on
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS drafts (
+            chat_id INTEGER PRIMARY KEY,
+            draft TEXT,
+            based_on_id INTEGER,
+            created_at TIMESTAMP
+        )""")
+
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+class PerChatBackend:
+    """One database file per chat, opened and closed around each use."""
+
+    def __init__(self):
+        # Database paths whose schema has been checked in this process
+        self.ready = set()
+
+    def acquire(self, chat_id, write=False):
+        os.makedirs(DB_DIR, exist_ok=True)
+        db_path = get_db_path(chat_id)
+        conn = sqlite3.connect(db_path)
+        if db_path not in self.ready:
+            ensure_schema(conn, chat_id)
+            self.ready.add(db_path)
+        return conn
+
+    def release(self, conn):
+        conn.close()
+
+    def close(self):
+        pass
+
+class ConsolidatedBackend:
+    """A single WAL-mode database with one writer and a pool of readers.
+
+    WAL lets the pooled readers see committed data while the writer is
+    busy. Connections are shared, so callers must not close them.
+    """
+
+    def __init__(self, db_path, pool_size=READER_POOL_SIZE):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.readers = queue.Queue()
+        self.reader_count = 0
+
+        self.writer = self._connect()
+        # Schema first: switching to WAL writes the database header, after
+        # which a new file can no longer take incremental auto_vacuum
+        ensure_schema(self.writer)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def acquire(self, chat_id, write=False):
+        if write:
+            return self.writer
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        # Grow the pool lazily up to its size, then wait for a free reader
+        if self.reader_count < self.pool_size:
+            self.reader_count += 1
+            return self._connect()
+        return self.readers.get()
+
+    def release(self, conn):
+        if conn is not self.writer:
+            self.readers.put(conn)
+
+    def close(self):
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        self.reader_count = 0
+        self.writer.close()
+
+def get_backend():
+    """Returns the storage backend selected by STORAGE_BACKEND."""
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "consolidated":
+            _backend = ConsolidatedBackend(get_consolidated_path())
+        elif STORAGE_BACKEND == "per-chat":
+            _backend = PerChatBackend()
+        else:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return _backend
+
+def close_backend():
+    """Closes any connections held by the current backend."""
+    global _backend
+    if _backend is not None:
+        _backend.close()
+        _backend = None
+
+@contextmanager
+def connection(chat_id, conn=None, write=False):
+    """Yields ``conn`` if given, otherwise a connection borrowed from the backend."""
+    if conn is not None:
+        yield conn
+        return
+    backend = get_backend()
+    conn = backend.acquire(chat_id, write=write)
+    try:
+        yield conn
+    finally:
+        backend.release(conn)
+
+def initialize_db(chat_id):
+    """Creates the database for the chat if it doesn't exist."""
+    with connection(chat_id, write=True):
+        pass
+
+class MessageWriter:
+    """Buffers messages for one chat and writes them in batched transactions.
+
+    One connection is kept open for the whole sync pass. Duplicates are
+    skipped by the unique index on (chat_id, telegram_id) with INSERT OR
+    IGNORE, and ``written``/``skipped`` count the outcome of every flushed row.
+    """
+
+    def __init__(self, chat_id, batch_size=WRITE_BATCH_SIZE):
+        self.chat_id = store_chat_id(chat_id)
+        self.batch_size = batch_size
+        self.written = 0
+        self.skipped = 0
+        self.pending = []
+
+        self.backend = get_backend()
+        self.conn = self.backend.acquire(self.chat_id, write=True)
+
+    def add(self, telegram_id, message_date, sender_id, message):
+        """Queues a message and flushes once the batch is full."""
+        self.pending.append((self.chat_id, telegram_id, message_date.timestamp(), sender_id, message))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all queued messages in a single transaction."""
+        if not self.pending:
+            return 0
+
+        started = time.perf_counter()
+        with self.conn:
+            # rowcount leaves out the rows written by the FTS triggers
+            cursor = self.conn.executemany(
+                "INSERT OR IGNORE INTO messages (chat_id, telegram_id, message_date, sender_id, message) VALUES (?, ?, ?, ?, ?)",
+                self.pending
+            )
+            inserted = cursor.rowcount
+        metrics.observe("db_write_seconds", time.perf_counter() - started)
+        metrics.inc("db_rows_written_total", inserted)
+        metrics.inc("db_rows_skipped_total", len(self.pending) - inserted)
+
+        self.written += inserted
+        self.skipped += len(self.pending) - inserted
+        self.pending = []
+        return inserted
+
+    def close(self):
+        """Flushes anything left and hands the connection back."""
+        try:
+            self.flush()
+        finally:
+            self.backend.release(self.conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def store_message(chat_id, telegram_id, message_date, sender_id, message):
+    """Stores a new message in the database."""
+    chat_id = store_chat_id(chat_id)
+    with metrics.timer("db_write_seconds"), connection(chat_id, write=True) as conn:
+        # The unique index on (chat_id, telegram_id) skips duplicates
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO messages (chat_id, telegram_id, message_date, sender_id, message) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, telegram_id, message_date.timestamp(), sender_id, message)
+            )
+
+def update_messages(chat_id, rows, conn=None):
+    """Inserts or overwrites messages, e.g. after edits.
+
+    ``rows`` holds (telegram_id, message_date, sender_id, message) tuples.
+    """
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            conn.executemany("""
+                INSERT INTO messages (chat_id, telegram_id, message_date, sender_id, message) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, telegram_id) DO UPDATE SET message = excluded.message
+            """, [(chat_id, telegram_id, message_date.timestamp(), sender_id, message)
+                  for telegram_id, message_date, sender_id, message in rows])
+            # The draft was written for the old text
+            conn.execute("DELETE FROM drafts WHERE chat_id = ?", (chat_id,))
+
+def delete_messages(chat_id, telegram_ids, conn=None):
+    """Deletes messages of a chat by Telegram ID; returns the number removed."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            cursor = conn.executemany(
+                "DELETE FROM messages WHERE chat_id = ? AND telegram_id = ?",
+                [(chat_id, telegram_id) for telegram_id in telegram_ids]
+            )
+            removed = cursor.rowcount
+            if removed:
+                conn.execute("DELETE FROM drafts WHERE chat_id = ?", (chat_id,))
+            return removed
+
+def delete_messages_outside_channels(telegram_ids):
+    """Deletes messages by Telegram ID from private chats and small groups.
+
+    Telegram reports these deletions without a chat, but their message IDs
+    are unique per account, so only the current account's private chats
+    and small groups are searched. Needs the consolidated backend; per-chat
+    files would all have to be opened, so this returns None there.
+    """
+    if STORAGE_BACKEND != "consolidated":
+        return None
+    with connection(None, write=True) as conn:
+        with conn:
+            cursor = conn.executemany(
+                f"DELETE FROM messages WHERE telegram_id = ? AND ({_account_chats_sql()})",
+                [(telegram_id,) for telegram_id in telegram_ids]
+            )
+            return cursor.rowcount
+
+def update_sync_info(chat_id, last_telegram_id, conn=None):
+    """Updates the sync information for a chat.
+
+    Pass ``conn`` to reuse a connection that is already open for the chat.
+    """
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            conn.execute("""
+                INSERT INTO sync_info (chat_id, last_sync_time, last_telegram_id) VALUES (?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    last_sync_time = excluded.last_sync_time,
+                    last_telegram_id = excluded.last_telegram_id
+            """, (chat_id, datetime.now().timestamp(), last_telegram_id))
+            # New messages make earlier drafts stale
+            conn.execute("DELETE FROM drafts WHERE chat_id = ? AND based_on_id < ?", (chat_id, last_telegram_id))
+
+def get_sync_info(chat_id, conn=None):
+    """Gets the last sync information for a chat."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_telegram_id FROM sync_info WHERE chat_id = ?", (chat_id,))
+        result = cursor.fetchone()
+    # A chat that was only backfilled has no sync position yet
+    return (result[0] or 0) if result else 0
+
+def update_backfill_state(chat_id, oldest_telegram_id, done=False, conn=None):
+    """Records how far back a chat's history has been backfilled."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            conn.execute("""
+                INSERT INTO sync_info (chat_id, backfill_oldest_id, backfill_done) VALUES (?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    backfill_oldest_id = excluded.backfill_oldest_id,
+                    backfill_done = excluded.backfill_done
+            """, (chat_id, oldest_telegram_id, int(done)))
+
+def get_backfill_state(chat_id, conn=None):
+    """Returns (oldest backfilled telegram_id or None, whether backfill finished)."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn) as conn:
+        row = conn.execute(
+            "SELECT backfill_oldest_id, backfill_done FROM sync_info WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+    if row is None:
+        return None, False
+    return row[0], bool(row[1])
+
+def count_messages(chat_id, conn=None):
+    """Returns how many messages are stored for a chat."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn) as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+def list_chat_ids():
+    """Returns the ids of all chats that have a store."""
+    if STORAGE_BACKEND == "per-chat":
+        chat_ids = []
+        for path in sorted(glob.glob(os.path.join(DB_DIR, "chat_*.db"))):
+            try:
+                chat_ids.append(int(os.path.basename(path)[len("chat_"):-len(".db")]))
+            except ValueError:
+                continue
+        return chat_ids
+
+    with connection(None) as conn:
+        rows = conn.execute("""
+            SELECT chat_id FROM messages GROUP BY chat_id
+            UNION SELECT chat_id FROM retention_policies
+        """).fetchall()
+    return [row[0] for row in rows]
+
+def get_retention_policy(chat_id, conn=None):
+    """Returns the retention policy of a chat, falling back to the defaults.
+
+    ``max_messages`` and ``max_age`` (seconds) of 0 or None mean no limit;
+    ``keep_all`` overrides both.
+    """
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn) as conn:
+        row = conn.execute(
+            "SELECT max_messages, max_age, keep_all FROM retention_policies WHERE chat_id = ?",
+            (chat_id,)
+        ).fetchone()
+    if row is None:
+        return {"max_messages": MESSAGE_HISTORY_LIMIT, "max_age": RETENTION_MAX_AGE, "keep_all": False}
+    return {"max_messages": row[0], "max_age": row[1], "keep_all": bool(row[2])}
+
+def has_retention_policy(chat_id, conn=None):
+    """Returns True if a chat has its own retention policy."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn) as conn:
+        return conn.execute(
+            "SELECT 1 FROM retention_policies WHERE chat_id = ?", (chat_id,)
+        ).fetchone() is not None
+
+def set_retention_policy(chat_id, max_messages=None, max_age=None, keep_all=False, conn=None):
+    """Stores the retention policy of a chat."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO retention_policies (chat_id, max_messages, max_age, keep_all) VALUES (?, ?, ?, ?)",
+                (chat_id, max_messages, max_age, int(keep_all))
+            )
+
+def clear_retention_policy(chat_id):
+    """Puts a chat back on the default retention policy."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, write=True) as conn:
+        with conn:
+            conn.execute("DELETE FROM retention_policies WHERE chat_id = ?", (chat_id,))
+
+def get_recent_messages(chat_id, limit=MESSAGE_HISTORY_LIMIT):
+    """Gets the most recent messages from a specific chat."""
+    chat_id = store_chat_id(chat_id)
+    if STORAGE_BACKEND == "per-chat" and not os.path.exists(get_db_path(chat_id)):
+        return []
+
+    with connection(chat_id) as conn:
+        cursor = conn.cursor()
+
+        # Get most recent messages first, with sender names
+        cursor.execute(f"""
+            SELECT m.message_date, {SENDER_NAME_SQL}, m.message
+            FROM messages m
+            LEFT JOIN senders s ON s.id = m.sender_id
+            WHERE m.chat_id = ?
+            ORDER BY m.message_date DESC
+            LIMIT ?
+        """, (chat_id, limit))
+
+        messages = cursor.fetchall()
+
+    # Return in chronological order (oldest first)
+    return list(reversed(messages))
+
+def save_senders(chat_id, rows, conn=None):
+    """Stores sender names; ``rows`` holds (id, display_name, username) tuples."""
+    chat_id = store_chat_id(chat_id)
+    now = datetime.now().timestamp()
+    with connection(chat_id, conn, write=True) as conn:
+        with conn:
+            conn.executemany("""
+                INSERT INTO senders (id, display_name, username, refreshed_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    display_name = excluded.display_name,
+                    username = excluded.username,
+                    refreshed_at = excluded.refreshed_at
+            """, [(sender_id, display_name, username, now) for sender_id, display_name, username in rows])
+
+def get_senders(chat_id, sender_ids, conn=None):
+    """Returns {sender_id: (display_name, refreshed_at)} for the known senders."""
+    chat_id = store_chat_id(chat_id)
+    sender_ids = list(sender_ids)
+    found = {}
+    with connection(chat_id, conn) as conn:
+        # Stay under SQLite's limit on bound parameters
+        for start in range(0, len(sender_ids), 500):
+            chunk = sender_ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for sender_id, display_name, refreshed_at in conn.execute(
+                f"SELECT id, display_name, refreshed_at FROM senders WHERE id IN ({placeholders})", chunk
+            ):
+                found[sender_id] = (display_name, refreshed_at)
+    return found
+
+def get_rolling_summary(chat_id):
+    """Returns the stored rolling summary of a chat as a dict, or None."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id) as conn:
+        row = conn.execute(
+            "SELECT summary, last_telegram_id, increments, updated_at FROM summaries WHERE chat_id = ?",
+            (chat_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {"summary": row[0], "last_telegram_id": row[1], "increments": row[2], "updated_at": row[3]}
+
+def save_rolling_summary(chat_id, summary, last_telegram_id, increments=0):
+    """Stores the rolling summary of a chat, replacing the previous one."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, write=True) as conn:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (chat_id, summary, last_telegram_id, increments, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, summary, last_telegram_id, increments, datetime.now().timestamp())
+            )
+
+def get_last_message(chat_id, conn=None):
+    """Returns (telegram_id, sender_id) of a chat's newest stored message, or None."""
+    chat_id = store_chat_id(chat_id)
+    if STORAGE_BACKEND == "per-chat" and not os.path.exists(get_db_path(chat_id)):
+        return None
+    with connection(chat_id, conn) as conn:
+        return conn.execute(
+            "SELECT telegram_id, sender_id FROM messages WHERE chat_id = ? ORDER BY telegram_id DESC LIMIT 1",
+            (chat_id,)
+        ).fetchone()
+
+def get_draft(chat_id):
+    """Returns the stored reply draft of a chat as a dict, or None."""
+    chat_id = store_chat_id(chat_id)
+    if STORAGE_BACKEND == "per-chat" and not os.path.exists(get_db_path(chat_id)):
+        return None
+    with connection(chat_id) as conn:
+        row = conn.execute(
+            "SELECT draft, based_on_id, created_at FROM drafts WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {"draft": row[0], "based_on_id": row[1], "created_at": row[2]}
+
+def save_draft(chat_id, draft, based_on_id):
+    """Stores a reply draft written for the messages up to ``based_on_id``."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, write=True) as conn:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO drafts (chat_id, draft, based_on_id, created_at) VALUES (?, ?, ?, ?)",
+                (chat_id, draft, based_on_id, datetime.now().timestamp())
+            )
+
+def delete_draft(chat_id):
+    """Drops a chat's reply draft, e.g. once it has been used."""
+    chat_id = store_chat_id(chat_id)
+    with connection(chat_id, write=True) as conn:
+        with conn:
+            conn.execute("DELETE FROM drafts WHERE chat_id = ?", (chat_id,))
+
+def migrate_to_consolidated():
+    """Imports every per-chat database file into the consolidated database.
+
+    Rows already present are skipped, so the migration can be rerun. The
+    per-chat files are left in place.
+    """
+    files = sorted(glob.glob(os.path.join(DB_DIR, "chat_*.db")))
+    target = ConsolidatedBackend(get_consolidated_path())
+    total_messages = 0
+
+    try:
+        for path in files:
+            try:
+                chat_id = int(os.path.basename(path)[len("chat_"):-len(".db")])
+            except ValueError:
+                continue
+
+            # Bring the source file up to the current schema first
+            source = sqlite3.connect(path)
+            ensure_schema(source, chat_id)
+            source.close()
+
+            conn = target.writer
+            conn.execute("ATTACH DATABASE ? AS source", (path,))
+            try:
+                with conn:
+                    cursor = conn.execute("""
+                        INSERT OR IGNORE INTO messages (chat_id, telegram_id, message_date, timestamp, sender, sender_id, message)
+                        SELECT ?, telegram_id, message_date, timestamp, sender, sender_id, message FROM source.messages
+                    """, (chat_id,))
+                    imported = cursor.rowcount
+                    conn.execute(
+                        "INSERT OR IGNORE INTO retention_policies SELECT * FROM source.retention_policies"
+                    )
+                    conn.execute("""
+                        INSERT INTO senders (id, display_name, username, refreshed_at)
+                        SELECT id, display_name, username, refreshed_at FROM source.senders WHERE true
+                        ON CONFLICT (id) DO UPDATE SET
+                            display_name = excluded.display_name,
+                            username = excluded.username,
+                            refreshed_at = excluded.refreshed_at
+                        WHERE excluded.refreshed_at > senders.refreshed_at
+                    """)
+                    # Keep whichever rolling summary covers more of the chat
+                    conn.execute("""
+                        INSERT INTO summaries (chat_id, summary, last_telegram_id, increments, updated_at)
+                        SELECT ?, summary, last_telegram_id, increments, updated_at FROM source.summaries WHERE true
+                        ON CONFLICT (chat_id) DO UPDATE SET
+                            summary = excluded.summary,
+                            last_telegram_id = excluded.last_telegram_id,
+                            increments = excluded.increments,
+                            updated_at = excluded.updated_at
+                        WHERE excluded.last_telegram_id > summaries.last_telegram_id
+                    """, (chat_id,))
+                    # Likewise for reply drafts and the message they answer
+                    conn.execute("""
+                        INSERT INTO drafts (chat_id, draft, based_on_id, created_at)
+                        SELECT ?, draft, based_on_id, created_at FROM source.drafts WHERE true
+                        ON CONFLICT (chat_id) DO UPDATE SET
+                            draft = excluded.draft,
+                            based_on_id = excluded.based_on_id,
+                            created_at = excluded.created_at
+                        WHERE excluded.based_on_id > drafts.based_on_id
+                    """, (chat_id,))
+                    row = conn.execute(
+                        "SELECT MAX(last_telegram_id), MIN(backfill_oldest_id), MAX(backfill_done) FROM source.sync_info"
+                    ).fetchone()
+            finally:
+                conn.execute("DETACH DATABASE source")
+
+            # Keep whichever sync position is further ahead
+            if row[0] and row[0] > get_sync_info(chat_id, conn=conn):
+                update_sync_info(chat_id, row[0], conn=conn)
+            # Likewise for how far back the chat was backfilled
+            oldest_id, done = get_backfill_state(chat_id, conn=conn)
+            if row[1] and (oldest_id is None or row[1] < oldest_id):
+                update_backfill_state(chat_id, row[1], done=bool(row[2]), conn=conn)
+
+            total_messages += imported
+            if DEBUG: print(f"Imported {imported} messages from chat {chat_id}")
+    finally:
+        target.close()
+
+    print(f"Migrated {total_messages} messages from {len(files)} chat databases into {get_consolidated_path()}")
+    return total_messages
@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Off unless a METRICS_FILE is configured; every recording call returns
+# straight away while disabled
+METRICS_ENABLED = False
+METRICS_FILE = None  # "*.json" for JSON, anything else for Prometheus text
+METRICS_PREFIX = "notifi_"
+
+# Histogram bucket upper bounds, in seconds unless noted
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # Tokens per second
+
+_counters = {}
+_histograms = {}
+
+class Histogram:
+    """Cumulative bucket counts with the sum and extremes of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(zip((str(bound) for bound in self.buckets), self.counts)),
+        }
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """Adds ``value`` to a counter; counter names end in _total."""
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Records one value in a histogram."""
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+@contextmanager
+def _timer(name, labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name, **labels):
+    """Times a ``with`` block into a histogram of seconds."""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return _timer(name, labels)
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
+
+def to_dict():
+    """Returns every metric recorded so far, with labels folded into the name."""
+    def label_name(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{key}={value}" for key, value in labels) + "}"
+
+    return {
+        "counters": {label_name(*key): value for key, value in sorted(_counters.items())},
+        "histograms": {label_name(*key): histogram.to_dict() for key, histogram in sorted(_histograms.items())},
+    }
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+def to_prometheus():
+    """Renders every metric in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(_counters.items()):
+        full_name = METRICS_PREFIX + name
+        if full_name not in typed:
+            lines.append(f"# TYPE {full_name} counter")
+            typed.add(full_name)
+        lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(_histograms.items()):
+        full_name = METRICS_PREFIX + name
+        if full_name not in typed:
+            lines.append(f"# TYPE {full_name} histogram")
+            typed.add(full_name)
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+        lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+def export(path=None):
+    """Writes the metrics to ``path`` (METRICS_FILE by default).
+
+    The file is replaced atomically, as the node_exporter textfile
+    collector expects. Does nothing while metrics are disabled.
+    """
+    path = path or METRICS_FILE
+    if not METRICS_ENABLED or not path:
+        return
+    if path.endswith(".json"):
+        text = json.dumps(to_dict(), indent=2)
+    else:
+        text = to_prometheus()
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
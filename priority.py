@@ -0,0 +1,71 @@
+import math
+import time
+
+# Score of each kind of chat before its other signals
+KIND_WEIGHTS = {"user": 3.0, "group": 1.0, "channel": 0.3}
+# Score per unread mention or reply to us, counting at most MAX_MENTIONS
+MENTION_WEIGHT = 4.0
+MAX_MENTIONS = 3
+# Score per e-fold of unread messages
+VOLUME_WEIGHT = 0.5
+# Score of a chat that just got a message, halving every RECENCY_HALF_LIFE seconds
+RECENCY_WEIGHT = 2.0
+RECENCY_HALF_LIFE = 6 * 3600
+
+# Seconds after which no new summary is started, and estimated prompt
+# tokens after which chats are only listed; 0 for no limit
+SUMMARY_TIME_BUDGET = 0
+SUMMARY_TOKEN_BUDGET = 0
+# Estimated prompt tokens per unread message, before it is fetched
+TOKENS_PER_MESSAGE = 30
+
+def score(dialog, now=None):
+    """Scores how much a chat's unread messages are worth reading first.
+
+    Uses only what the dialog listing already has: unread mentions and
+    replies, the kind of chat, how many messages are unread and how
+    recently the last one arrived.
+    """
+    now = time.time() if now is None else now
+    value = KIND_WEIGHTS.get(dialog.kind, 1.0)
+    value += MENTION_WEIGHT * min(dialog.unread_mentions_count, MAX_MENTIONS)
+    value += VOLUME_WEIGHT * math.log1p(dialog.unread_count)
+    if dialog.last_message_at:
+        age = max(0.0, now - dialog.last_message_at)
+        value += RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE)
+    return value
+
+def estimate_tokens(dialog):
+    """Estimates the prompt tokens needed to summarize a chat's unread messages."""
+    return dialog.unread_count * TOKENS_PER_MESSAGE
+
+def plan(dialogs, token_budget=None, now=None):
+    """Orders chats by score and splits them by the token budget.
+
+    Returns (chosen, skipped), both highest priority first. The first chat
+    is always chosen, so a budget never leaves nothing to read.
+    """
+    token_budget = SUMMARY_TOKEN_BUDGET if token_budget is None else token_budget
+    now = time.time() if now is None else now
+    ranked = sorted(dialogs, key=lambda dialog: score(dialog, now), reverse=True)
+    if not token_budget:
+        return ranked, []
+
+    chosen, skipped = [], []
+    tokens = 0
+    for dialog in ranked:
+        estimate = estimate_tokens(dialog)
+        if chosen and tokens + estimate > token_budget:
+            skipped.append(dialog)
+        else:
+            chosen.append(dialog)
+            tokens += estimate
+    return chosen, skipped
+
+def format_listing(dialogs):
+    """Lists chats that were not summarized, with their unread counts."""
+    lines = []
+    for dialog in dialogs:
+        mentions = f", {dialog.unread_mentions_count} mentions" if dialog.unread_mentions_count else ""
+        lines.append(f"- {dialog.title}: {dialog.unread_count} unread{mentions}")
+    return "\n".join(lines)
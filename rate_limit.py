@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+class RateLimiter:
+    """Token bucket shared by every concurrent Telegram request.
+
+    ``rate`` tokens are added per second up to ``burst``. A FloodWait
+    reported by Telegram pauses the whole bucket, so all workers back off
+    together instead of each one hitting the same limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waited = 0.0  # Seconds spent sleeping on FloodWait
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stops handing out tokens for ``seconds`` from now."""
+        now = time.monotonic()
+        until = now + seconds
+        # Overlapping FloodWaits from several workers only count once
+        self.waited += max(0.0, until - max(self.paused_until, now))
+        self.paused_until = max(self.paused_until, until)
+
+    async def acquire(self, tokens=1):
+        """Waits until ``tokens`` are available and takes them."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
@@ -0,0 +1,121 @@
+import time
+
+import message_store
+import metrics
+from message_store import connection, get_retention_policy, list_chat_ids
+
+DEBUG = True
+
+# Rows deleted per transaction, and free pages returned to the file system
+# per incremental_vacuum step, so writers are never blocked for long
+RETENTION_BATCH_SIZE = 1000
+VACUUM_STEP_PAGES = 1000
+
+def _delete_batches(conn, select_sql, params, limit=None):
+    """Deletes the rows picked by ``select_sql`` in batched transactions.
+
+    ``select_sql`` selects message ids and takes a trailing LIMIT
+    parameter. At most ``limit`` rows are deleted when given. Returns the
+    number of rows deleted.
+    """
+    deleted = 0
+    while limit is None or deleted < limit:
+        batch = RETENTION_BATCH_SIZE if limit is None else min(RETENTION_BATCH_SIZE, limit - deleted)
+        with conn:
+            cursor = conn.execute(f"DELETE FROM messages WHERE id IN ({select_sql} LIMIT ?)", (*params, batch))
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch:
+            break
+    return deleted
+
+def apply_retention(chat_id, conn=None):
+    """Deletes the messages of a chat that its retention policy no longer keeps.
+
+    Both limits walk the (chat_id, message_date) index from the oldest
+    message, so no query scans or sorts the whole chat. Returns the number
+    of rows deleted.
+    """
+    with connection(chat_id, conn, write=True) as conn:
+        policy = get_retention_policy(chat_id, conn=conn)
+        if policy["keep_all"]:
+            return 0
+
+        deleted = 0
+        if policy["max_age"]:
+            cutoff = time.time() - policy["max_age"]
+            deleted += _delete_batches(conn, """
+                SELECT id FROM messages
+                WHERE chat_id = ? AND message_date < ?
+                ORDER BY message_date ASC
+            """, (chat_id, cutoff))
+
+        if policy["max_messages"]:
+            count = conn.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+            if count > policy["max_messages"]:
+                deleted += _delete_batches(conn, """
+                    SELECT id FROM messages
+                    WHERE chat_id = ?
+                    ORDER BY message_date ASC
+                """, (chat_id,), limit=count - policy["max_messages"])
+
+    metrics.inc("retention_rows_deleted_total", deleted)
+    if DEBUG and deleted:
+        print(f"Deleted {deleted} old messages from chat {chat_id}")
+    return deleted
+
+def _database_size(conn):
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+def vacuum(conn):
+    """Returns free pages to the file system; returns the bytes reclaimed.
+
+    Databases created before incremental vacuum was enabled get one full
+    VACUUM to switch them over; later passes free pages in steps of
+    VACUUM_STEP_PAGES.
+    """
+    before = _database_size(conn)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        while conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+    return before - _database_size(conn)
+
+def maintain(vacuum_files=True):
+    """Applies every chat's retention policy, then reclaims the freed space.
+
+    Meant to run on its own schedule rather than with every sync. Returns
+    a report with the chats checked, rows deleted and bytes reclaimed.
+    """
+    started = time.monotonic()
+    report = {"chats": 0, "rows": 0, "bytes": 0, "elapsed": 0.0}
+
+    for chat_id in list_chat_ids():
+        if message_store.STORAGE_BACKEND == "per-chat":
+            # Each chat is its own file, so vacuum it while it is open
+            with connection(chat_id, write=True) as conn:
+                rows = apply_retention(chat_id, conn=conn)
+                if rows and vacuum_files:
+                    report["bytes"] += vacuum(conn)
+        else:
+            rows = apply_retention(chat_id)
+        report["chats"] += 1
+        report["rows"] += rows
+
+    if message_store.STORAGE_BACKEND == "consolidated" and vacuum_files and report["rows"]:
+        with connection(None, write=True) as conn:
+            report["bytes"] += vacuum(conn)
+            # Fold the WAL back so the reclaimed space shows on disk
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    report["elapsed"] = time.monotonic() - started
+    metrics.observe("retention_seconds", report["elapsed"])
+    metrics.inc("retention_bytes_reclaimed_total", report["bytes"])
+    return report
+
+def format_report(report):
+    return (f"Checked {report['chats']} chats: deleted {report['rows']} messages, "
+            f"reclaimed {report['bytes'] / 1024:.0f} KiB in {report['elapsed']:.1f}s")
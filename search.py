@@ -0,0 +1,102 @@
+import re
+import sqlite3
+
+from message_store import SENDER_NAME_SQL, connection, store_chat_id
+
+# Best BM25 hits to consider, messages of context kept on each side of a
+# hit, and the size of the retrieved context in characters
+RETRIEVAL_HITS = 20
+CONTEXT_MESSAGES = 2
+PROMPT_CHAR_BUDGET = 12000
+
+def build_match_query(query):
+    """Turns free text into an FTS5 query that matches any of its words.
+
+    Each word is quoted, so FTS5 operators and punctuation in the user's
+    text cannot break the query.
+    """
+    words = [word for word in re.findall(r"\w+", query.lower()) if len(word) > 1]
+    return " OR ".join(f'"{word}"' for word in dict.fromkeys(words))
+
+def search_messages(chat_id, query, limit=RETRIEVAL_HITS, conn=None):
+    """Returns (id, message_date) of the best BM25 matches in a chat, best first."""
+    chat_id = store_chat_id(chat_id)
+    match = build_match_query(query)
+    if not match:
+        return []
+
+    with connection(chat_id, conn) as conn:
+        try:
+            return conn.execute("""
+                SELECT m.id, m.message_date
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND m.chat_id = ?
+                ORDER BY bm25(messages_fts)
+                LIMIT ?
+            """, (match, chat_id, limit)).fetchall()
+        except sqlite3.OperationalError:
+            # No full-text index in this database
+            return []
+
+def _context_around(conn, chat_id, message_date, size):
+    """Returns the rows around one message, using the (chat_id, message_date) index."""
+    before = conn.execute(f"""
+        SELECT m.id, m.message_date, {SENDER_NAME_SQL}, m.message
+        FROM messages m LEFT JOIN senders s ON s.id = m.sender_id
+        WHERE m.chat_id = ? AND m.message_date <= ?
+        ORDER BY m.message_date DESC LIMIT ?
+    """, (chat_id, message_date, size + 1)).fetchall()
+    after = conn.execute(f"""
+        SELECT m.id, m.message_date, {SENDER_NAME_SQL}, m.message
+        FROM messages m LEFT JOIN senders s ON s.id = m.sender_id
+        WHERE m.chat_id = ? AND m.message_date > ?
+        ORDER BY m.message_date ASC LIMIT ?
+    """, (chat_id, message_date, size)).fetchall()
+    return before + after
+
+def retrieve_context(chat_id, query, char_budget=PROMPT_CHAR_BUDGET, context=CONTEXT_MESSAGES):
+    """Picks the messages most relevant to ``query`` within a character budget.
+
+    Hits are taken best first, each with its neighbouring messages, until
+    the budget is used. Returns (message_date, sender, message) rows in
+    chronological order, with None between runs that are not adjacent.
+    """
+    chat_id = store_chat_id(chat_id)
+    blocks = []  # Runs of neighbouring messages, as {id: row}
+    selected = set()
+    used = 0
+
+    with connection(chat_id) as conn:
+        for hit_id, message_date in search_messages(chat_id, query, conn=conn):
+            window = _context_around(conn, chat_id, message_date, context)
+            new_rows = [row for row in window if row[0] not in selected]
+            if not new_rows:
+                continue
+
+            cost = sum(len(row[3] or "") + 40 for row in new_rows)
+            if used + cost > char_budget:
+                if selected:
+                    break
+                # Always keep the best hit itself, even over budget
+                window = new_rows = [row for row in window if row[0] == hit_id] or window[:1]
+                cost = len(window[0][3] or "") + 40
+
+            # Windows that overlap earlier ones join the same run
+            ids = {row[0] for row in window}
+            block = {row[0]: row for row in new_rows}
+            for other in [other for other in blocks if other.keys() & ids]:
+                block.update(other)
+                blocks.remove(other)
+            blocks.append(block)
+
+            selected.update(row[0] for row in new_rows)
+            used += cost
+
+    result = []
+    for block in sorted(blocks, key=lambda block: min(row[1] for row in block.values())):
+        if result:
+            result.append(None)  # Gap between separate runs
+        for row in sorted(block.values(), key=lambda row: (row[1], row[0])):
+            result.append((row[1], row[2], row[3]))
+    return result
@@ -0,0 +1,83 @@
+import time
+
+import metrics
+from message_store import get_senders, save_senders
+
+DEBUG = True
+
+# Stored names are refreshed after this many seconds; senders are looked
+# up with get_entity this many at a time
+SENDER_TTL = 7 * 24 * 3600
+ENTITY_BATCH_SIZE = 100
+
+def sender_row(sender_id, entity):
+    """Returns the (id, display_name, username) row stored for an entity."""
+    from telethon.utils import get_display_name
+
+    return sender_id, get_display_name(entity) or None, getattr(entity, "username", None)
+
+class SenderBatch:
+    """Collects the senders of the messages seen in one pass over a chat.
+
+    Telethon attaches the users and chats returned with each page of
+    history to its messages, so most names arrive without another request.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.entities = {}
+
+    def add(self, message):
+        sender_id = message.sender_id
+        if sender_id is None:
+            return
+        self.ids.add(sender_id)
+        entity = getattr(message, "sender", None)
+        if entity is not None:
+            self.entities[sender_id] = entity
+
+    def __len__(self):
+        return len(self.ids)
+
+async def resolve(client, chat_id, batch, conn=None, limiter=None):
+    """Stores the names of a batch's senders; returns {sender_id: name}.
+
+    Names refreshed within SENDER_TTL are read from the store. Stale or
+    unknown senders are taken from the entities attached to the messages,
+    and only the rest are fetched with batched get_entity calls.
+    """
+    if not batch:
+        return {}
+
+    known = get_senders(chat_id, batch.ids, conn=conn)
+    fresh_after = time.time() - SENDER_TTL
+    names = {sender_id: name for sender_id, (name, refreshed_at) in known.items() if name}
+    stale = [sender_id for sender_id in batch.ids
+             if sender_id not in known or (known[sender_id][1] or 0) < fresh_after]
+    if not stale:
+        return names
+
+    rows = [sender_row(sender_id, batch.entities[sender_id]) for sender_id in stale if sender_id in batch.entities]
+    missing = [sender_id for sender_id in stale if sender_id not in batch.entities]
+    for start in range(0, len(missing), ENTITY_BATCH_SIZE):
+        chunk = missing[start:start + ENTITY_BATCH_SIZE]
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            entities = await client.get_entity(chunk)
+        except (ValueError, TypeError) as e:
+            # Not in Telethon's entity cache; keep showing the id
+            if DEBUG: print(f"Could not resolve {len(chunk)} senders in chat {chat_id}: {e}")
+            continue
+        metrics.inc("sender_lookups_total", len(chunk))
+        rows += [sender_row(sender_id, entity) for sender_id, entity in zip(chunk, entities)]
+
+    if rows:
+        save_senders(chat_id, rows, conn=conn)
+        metrics.inc("senders_refreshed_total", len(rows))
+        names.update((sender_id, name) for sender_id, name, _ in rows if name)
+    return names
+
+def name_rows(rows, names):
+    """Replaces the sender ids of (timestamp, sender_id, text, ...) rows with names."""
+    return [(row[0], names.get(row[1]) or row[1] or "Unknown", *row[2:]) for row in rows]
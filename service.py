@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import json
+import os
+import sys
+
+import dialog_cache
+import llm
+import message_store
+import metrics
+
+DEBUG = True
+
+# Unix socket the daemon listens on; None puts it in DB_DIR
+SOCKET_PATH = None
+SOCKET_NAME = "notifi.sock"
+# Longest line either side reads, so long summaries fit in one message
+MAX_LINE = 16 * 1024 * 1024
+
+# Commands a running daemon runs on behalf of the CLI. reply only goes
+# there with --draft-only, since sending needs confirmation on this terminal
+REMOTE_COMMANDS = {"fetch", "fetch-unread", "summarize-unread", "analyze"}
+
+# Where print() goes while a request is being handled
+_output = contextvars.ContextVar("output", default=None)
+
+def get_socket_path():
+    return SOCKET_PATH or os.path.join(message_store.DB_DIR, SOCKET_NAME)
+
+def handles(argv):
+    """Returns True if a running daemon can run this command line."""
+    if not argv:
+        return False
+    return argv[0] in REMOTE_COMMANDS or (argv[0] == "reply" and "--draft-only" in argv)
+
+def _send(writer, **event):
+    writer.write(json.dumps(event).encode() + b"\n")
+
+class _OutputRouter:
+    """Stands in for sys.stdout and sends each request's output to its client.
+
+    Output written outside a request goes to the real stdout.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        writer = _output.get()
+        if writer is None:
+            return self.stdout.write(text)
+        if text and not writer.is_closing():
+            _send(writer, type="output", text=text)
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+async def serve(run_command, get_client):
+    """Keeps Telegram, the store and the LLM session open and runs CLI commands.
+
+    Each request is one JSON line, {"argv": [...]}. The reply is a stream of
+    {"type": "output", "text": ...} lines with everything the command prints,
+    ending with {"type": "done", "ok": ..., "error": ...}. Commands share one
+    client and one store, so they run one at a time.
+    """
+    path = get_socket_path()
+    if os.path.exists(path):
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(path)
+        else:
+            writer.close()
+            print(f"A daemon is already listening on {path}")
+            return
+
+    # Connect and open everything up front so the first request is warm
+    await get_client()
+    message_store.get_backend()
+    await llm.get_session()
+
+    lock = asyncio.Lock()
+
+    async def handle(reader, writer):
+        try:
+            request = json.loads(await reader.readline() or b"null")
+            argv = request["argv"]
+        except (ValueError, TypeError, KeyError):
+            _send(writer, type="done", ok=False, error="Malformed request")
+            writer.close()
+            return
+
+        async with lock:
+            if DEBUG: print(f"Running: {' '.join(argv)}")
+            # Telegram state may have moved since the previous request
+            dialog_cache.invalidate()
+            token = _output.set(writer)
+            try:
+                with metrics.timer("command_seconds", command=argv[0] if argv else ""):
+                    await run_command(argv)
+            except Exception as e:
+                _output.reset(token)
+                if DEBUG: print(f"Command failed: {e}")
+                _send(writer, type="done", ok=False, error=str(e))
+            else:
+                _output.reset(token)
+                _send(writer, type="done", ok=True, error=None)
+            metrics.export()
+
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    server = await asyncio.start_unix_server(handle, path, limit=MAX_LINE)
+    stdout = sys.stdout
+    sys.stdout = _OutputRouter(stdout)
+    print(f"Serving on {path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        sys.stdout = stdout
+        if os.path.exists(path):
+            os.unlink(path)
+
+async def call(argv):
+    """Runs a command line in the daemon and prints its output as it arrives.
+
+    Returns False without doing anything when no daemon is listening.
+    """
+    try:
+        reader, writer = await asyncio.open_unix_connection(get_socket_path(), limit=MAX_LINE)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+
+    try:
+        _send(writer, argv=argv)
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                print("The daemon closed the connection before the command finished")
+                break
+            event = json.loads(line)
+            if event["type"] == "output":
+                sys.stdout.write(event["text"])
+                sys.stdout.flush()
+            elif event["type"] == "done":
+                if not event["ok"]:
+                    print(f"Error: {event['error']}")
+                break
+    finally:
+        writer.close()
+    return True
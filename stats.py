@@ -0,0 +1,285 @@
+import os
+import time
+from datetime import datetime
+
+import accounts
+import dialog_cache
+import message_store
+from message_store import connection, get_senders, list_chat_ids
+
+DEBUG = True
+
+STATS_CACHE_NAME = "stats_cache.npz"
+STATS_CHUNK_ROWS = 50000  # Rows converted to arrays at a time
+STATS_TOP = 10  # Chats, senders and contacts listed in each section
+# Gaps longer than this start a new conversation instead of being a reply
+MAX_REPLY_GAP = 24 * 3600
+
+_COLUMNS = ("chat_id", "telegram_id", "message_date", "sender_id")
+
+def get_cache_path():
+    return os.path.join(message_store.DB_DIR, STATS_CACHE_NAME)
+
+def _empty_columns(np):
+    return {
+        "chat_id": np.empty(0, dtype=np.int64),
+        "telegram_id": np.empty(0, dtype=np.int64),
+        "message_date": np.empty(0, dtype=np.float64),
+        "sender_id": np.empty(0, dtype=np.int64),
+    }
+
+def _load_cache(np):
+    """Returns (columns, {chat_id: (rows, max telegram_id)}) saved by the last run."""
+    try:
+        with np.load(get_cache_path()) as data:
+            columns = {name: data[name] for name in _COLUMNS}
+            chats = {int(chat_id): (int(rows), int(max_id))
+                     for chat_id, rows, max_id in zip(data["chats"], data["chat_rows"], data["chat_max_ids"])}
+    except (OSError, KeyError, ValueError):
+        return _empty_columns(np), {}
+    return columns, chats
+
+def _save_cache(np, columns, chats):
+    path = get_cache_path()
+    chat_ids = sorted(chats)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(
+            f, **columns,
+            chats=np.array(chat_ids, dtype=np.int64),
+            chat_rows=np.array([chats[chat_id][0] for chat_id in chat_ids], dtype=np.int64),
+            chat_max_ids=np.array([chats[chat_id][1] for chat_id in chat_ids], dtype=np.int64),
+        )
+    os.replace(path + ".tmp", path)
+
+def _read_rows(np, conn, chat_id, after_id):
+    """Streams a chat's messages above ``after_id`` into arrays, a chunk at a time."""
+    cursor = conn.execute("""
+        SELECT telegram_id, CAST(message_date AS REAL), COALESCE(sender_id, 0)
+        FROM messages
+        WHERE chat_id = ? AND telegram_id > ?
+        ORDER BY telegram_id
+    """, (chat_id, after_id))
+    parts = []
+    while True:
+        rows = cursor.fetchmany(STATS_CHUNK_ROWS)
+        if not rows:
+            break
+        block = np.array(rows, dtype=np.float64)
+        parts.append({
+            "chat_id": np.full(len(block), chat_id, dtype=np.int64),
+            "telegram_id": block[:, 0].astype(np.int64),
+            "message_date": block[:, 1],
+            "sender_id": block[:, 2].astype(np.int64),
+        })
+    return parts
+
+def load_columns():
+    """Returns every stored message as columns of NumPy arrays.
+
+    The columns are cached on disk and refreshed incrementally: a chat
+    whose row count still matches the cache only has the rows above its
+    newest cached telegram_id read. Chats that lost or gained older rows,
+    through retention or backfill, are read again in full. Returns the
+    columns and the number of rows read from the store.
+    """
+    import numpy as np
+
+    columns, cached = _load_cache(np)
+    chats = {}
+    parts = []
+    reloaded = set()
+    read = 0
+
+    for chat_id in list_chat_ids():
+        with connection(chat_id) as conn:
+            rows, max_id = conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(telegram_id), 0) FROM messages WHERE chat_id = ? AND telegram_id IS NOT NULL",
+                (chat_id,)
+            ).fetchone()
+            cached_rows, cached_max_id = cached.get(chat_id, (0, 0))
+            if (rows, max_id) == (cached_rows, cached_max_id):
+                chats[chat_id] = (rows, max_id)
+                continue
+
+            newer = conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ? AND telegram_id > ?", (chat_id, cached_max_id)
+            ).fetchone()[0]
+            if cached_rows + newer != rows:
+                # Rows below the cached ones changed; read the chat again
+                reloaded.add(chat_id)
+                cached_max_id = 0
+            chat_parts = _read_rows(np, conn, chat_id, cached_max_id)
+        parts += chat_parts
+        read += sum(len(part["chat_id"]) for part in chat_parts)
+        chats[chat_id] = (rows, max_id)
+
+    # Drop the cached rows of chats that were read again or no longer exist
+    dropped = reloaded | (set(cached) - set(chats))
+    if dropped:
+        keep = ~np.isin(columns["chat_id"], np.array(sorted(dropped), dtype=np.int64))
+        columns = {name: column[keep] for name, column in columns.items()}
+
+    if parts or dropped or chats.keys() != cached.keys():
+        columns = {name: np.concatenate([columns[name], *(part[name] for part in parts)]) for name in _COLUMNS}
+        _save_cache(np, columns, chats)
+    return columns, read
+
+def _group_median(np, keys, values):
+    """Returns the keys, lower median of ``values`` and count for each key."""
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    unique, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    return unique, values[starts + (counts - 1) // 2], counts
+
+def _format_duration(seconds):
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds:.0f}s"
+
+def compute(columns, days=None, now=None, self_id=None):
+    """Aggregates the message columns into the numbers of the stats report.
+
+    ``days`` limits the messages to that many days back. Hours are local.
+    ``self_id`` is our own user id; without it reply times are left out.
+    """
+    import numpy as np
+
+    now = time.time() if now is None else now
+    chat_ids, dates, sender_ids = columns["chat_id"], columns["message_date"], columns["sender_id"]
+    if days:
+        recent = dates >= now - days * 86400
+        chat_ids, dates, sender_ids = chat_ids[recent], dates[recent], sender_ids[recent]
+
+    report = {"messages": int(len(chat_ids))}
+    if not len(chat_ids):
+        report.update(chats=[], hours=[0] * 24, senders=[], latency=[])
+        return report
+
+    # Messages per chat and hour of the day, in one bincount
+    hours = ((dates + time.localtime(now).tm_gmtoff) // 3600 % 24).astype(np.int64)
+    chats, chat_index = np.unique(chat_ids, return_inverse=True)
+    by_chat_hour = np.bincount(chat_index * 24 + hours, minlength=len(chats) * 24).reshape(len(chats), 24)
+    totals = by_chat_hour.sum(axis=1)
+    first = np.full(len(chats), np.inf)
+    last = np.full(len(chats), -np.inf)
+    np.minimum.at(first, chat_index, dates)
+    np.maximum.at(last, chat_index, dates)
+    active_hours = np.maximum((last - first) / 3600, 1)
+    report["chats"] = [
+        {
+            "chat_id": int(chats[i]),
+            "messages": int(totals[i]),
+            "per_hour": float(totals[i] / active_hours[i]),
+            "peak_hour": int(by_chat_hour[i].argmax()),
+        }
+        for i in np.argsort(-totals, kind="stable")[:STATS_TOP]
+    ]
+    report["hours"] = by_chat_hour.sum(axis=0).tolist()
+
+    # Top senders; 0 is a sender that was never known
+    known = sender_ids != 0
+    senders, sender_counts = np.unique(sender_ids[known], return_counts=True)
+    top = np.argsort(-sender_counts, kind="stable")[:STATS_TOP]
+    # The chats each sender wrote in, to look the name up in
+    report["senders"] = [
+        {"sender_id": int(senders[i]), "messages": int(sender_counts[i]),
+         "chat_ids": np.unique(chat_ids[sender_ids == senders[i]]).tolist()}
+        for i in top
+    ]
+
+    # Reply latency in private chats: the gap whenever the turn passes
+    # between us and the contact
+    order = np.lexsort((dates, chat_ids))
+    chat_sorted, date_sorted = chat_ids[order], dates[order]
+    ours = sender_ids[order] == self_id if self_id is not None else np.zeros(len(order), dtype=bool)
+    gaps = np.diff(date_sorted)
+    turns = ((chat_sorted[1:] == chat_sorted[:-1]) & (chat_sorted[1:] > 0)
+             & (ours[1:] != ours[:-1]) & (gaps <= MAX_REPLY_GAP))
+    latency = {}
+    for side, mask in (("ours", turns & ours[1:]), ("theirs", turns & ~ours[1:])):
+        keys, medians, counts = _group_median(np, chat_sorted[1:][mask], gaps[mask])
+        for chat_id, median, count in zip(keys.tolist(), medians.tolist(), counts.tolist()):
+            latency.setdefault(chat_id, {})[side] = (median, count)
+    ranked = sorted(latency.items(), key=lambda item: -sum(count for _, count in item[1].values()))
+    report["latency"] = [{"chat_id": chat_id, **sides} for chat_id, sides in ranked[:STATS_TOP]]
+    return report
+
+def unread_growth(days=None, now=None):
+    """Returns (day, total unread at the day's last listing) from the unread history."""
+    import numpy as np
+
+    now = time.time() if now is None else now
+    rows = dialog_cache.load_unread_history(now - days * 86400 if days else 0)
+    if not rows:
+        return []
+    history = np.array(rows, dtype=np.float64)
+    taken_at, unread = history[:, 0], history[:, 2]
+    listings, listing_index = np.unique(taken_at, return_inverse=True)
+    totals = np.bincount(listing_index, weights=unread)
+    # The last listing of each local day
+    local_days = (listings + time.localtime(now).tm_gmtoff) // 86400
+    last_of_day = np.r_[local_days[1:] != local_days[:-1], True]
+    return [(datetime.fromtimestamp(taken).strftime("%Y-%m-%d"), int(total))
+            for taken, total in zip(listings[last_of_day], totals[last_of_day])]
+
+def _chat_titles():
+    snapshot = dialog_cache.DialogSnapshot.load()
+    return {info.id: info.title for info in snapshot} if snapshot is not None else {}
+
+def format_report(report, growth, titles=None, self_id=None):
+    titles = titles or {}
+
+    def title(chat_id):
+        return titles.get(chat_id) or f"Chat {chat_id}"
+
+    lines = [f"{report['messages']} messages"]
+    if report["chats"]:
+        lines += ["", "Busiest chats:"]
+        lines += [f"  {title(chat['chat_id'])}: {chat['messages']} messages, {chat['per_hour']:.2f}/hour, "
+                  f"busiest at {chat['peak_hour']:02d}:00" for chat in report["chats"]]
+
+        peak = max(report["hours"]) or 1
+        lines += ["", "Messages by hour of day:"]
+        lines += [f"  {hour:02d}:00 {count:>8} {'#' * round(30 * count / peak)}"
+                  for hour, count in enumerate(report["hours"])]
+
+    if report["senders"]:
+        lines += ["", "Top senders:"]
+        for sender in report["senders"]:
+            name = "You" if sender["sender_id"] == self_id else None
+            for chat_id in sender["chat_ids"]:
+                if name:
+                    break
+                name = (get_senders(chat_id, [sender["sender_id"]]).get(sender["sender_id"]) or (None,))[0]
+            lines.append(f"  {name or sender['sender_id']}: {sender['messages']} messages")
+
+    if report["latency"]:
+        lines += ["", "Median reply time in private chats:"]
+        for contact in report["latency"]:
+            parts = []
+            if "theirs" in contact:
+                parts.append(f"they reply in {_format_duration(contact['theirs'][0])} ({contact['theirs'][1]}x)")
+            if "ours" in contact:
+                parts.append(f"you reply in {_format_duration(contact['ours'][0])} ({contact['ours'][1]}x)")
+            lines.append(f"  {title(contact['chat_id'])}: {', '.join(parts)}")
+
+    if growth:
+        lines += ["", "Unread messages by day:"]
+        previous = None
+        for day, total in growth:
+            change = "" if previous is None else f" ({total - previous:+d})"
+            lines.append(f"  {day}: {total}{change}")
+            previous = total
+    return "\n".join(lines)
+
+def run(days=None):
+    """Builds the stats report from the store and the unread history."""
+    started = time.perf_counter()
+    columns, read = load_columns()
+    if DEBUG: print(f"Loaded {len(columns['chat_id'])} messages ({read} read from the store) "
+                    f"in {time.perf_counter() - started:.2f}s")
+    self_id = accounts.self_id()
+    report = compute(columns, days=days, self_id=self_id)
+    return format_report(report, unread_growth(days), _chat_titles(), self_id=self_id)
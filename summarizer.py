@@ -0,0 +1,140 @@
+import asyncio
+
+import message_handler
+import senders
+from message_store import MESSAGE_HISTORY_LIMIT
+
+# A window closes after this many messages or once its formatted text
+# reaches the character budget, whichever comes first
+WINDOW_MESSAGES = MESSAGE_HISTORY_LIMIT
+CONTEXT_CHAR_BUDGET = 12000
+MAP_CONCURRENCY = 4
+
+async def iter_unread_windows(client, dialog, window_messages=None, char_budget=None):
+    """Yields the unread messages of a chat as windows, oldest first.
+
+    Messages are read from Telegram as the windows are consumed, so only
+    the current window is held in memory. Each message is a
+    (timestamp, sender name, text, telegram_id) tuple.
+    """
+    window_messages = window_messages or WINDOW_MESSAGES
+    char_budget = char_budget or CONTEXT_CHAR_BUDGET
+
+    # Reading upward from the read marker gives oldest-first order; without
+    # it, walk down from the newest message and reverse each window instead
+    reverse = bool(dialog.read_inbox_max_id)
+    kwargs = {"min_id": dialog.read_inbox_max_id, "reverse": True} if reverse else {}
+
+    async def named(window, batch):
+        names = await senders.resolve(client, dialog.id, batch)
+        return senders.name_rows(window if reverse else window[::-1], names)
+
+    window = []
+    batch = senders.SenderBatch()
+    chars = 0
+    async for message in client.iter_messages(dialog.entity, limit=dialog.unread_count, **kwargs):
+        if not message.text:
+            continue
+        window.append((message.date.timestamp(), message.sender_id, message.text, message.id))
+        batch.add(message)
+        chars += len(message.text) + 40  # Timestamp and sender overhead
+        if len(window) >= window_messages or chars >= char_budget:
+            yield await named(window, batch)
+            window = []
+            batch = senders.SenderBatch()
+            chars = 0
+    if window:
+        yield await named(window, batch)
+
+def _map_prompt(window, title, index):
+    chat_context = message_handler.format_chat_context(window)
+    prompt = f"Here is part {index + 1} of the unread messages from '{title}':\n\n{chat_context}\n\n"
+    prompt += "Please summarize this part briefly, keeping important facts, decisions, questions and action items."
+    return prompt
+
+def _reduce_prompt(partials, title):
+    parts = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(partials))
+    prompt = f"Here are summaries of consecutive parts of the unread messages from '{title}':\n\n{parts}\n\n"
+    prompt += "Please combine them into one concise summary, highlighting any important information or action items."
+    return prompt
+
+async def _generate(prompt, semaphore):
+    async with semaphore:
+        return await message_handler.generate(prompt, stream_output=False)
+
+async def reduce_summaries(partials, title, semaphore, char_budget=None):
+    """Merges partial summaries in order until a single digest remains."""
+    char_budget = char_budget or CONTEXT_CHAR_BUDGET
+    while len(partials) > 1:
+        # Group consecutive partials so each reduce prompt fits the budget
+        groups = [[]]
+        size = 0
+        for summary in partials:
+            if groups[-1] and size + len(summary) > char_budget:
+                groups.append([])
+                size = 0
+            groups[-1].append(summary)
+            size += len(summary)
+
+        if len(groups) == len(partials):
+            # Every summary fills the budget alone; pair them up to make progress
+            groups = [partials[i:i + 2] for i in range(0, len(partials), 2)]
+
+        partials = await asyncio.gather(*(_reduce_group(group, title, semaphore) for group in groups))
+    return partials[0] if partials else ""
+
+async def _reduce_group(group, title, semaphore):
+    if len(group) == 1:
+        return group[0]
+    return await _generate(_reduce_prompt(group, title), semaphore)
+
+async def summarize_backlog(client, dialog, semaphore=None):
+    """Summarizes every unread message of a chat with map-reduce.
+
+    Windows are summarized as they are read, with at most MAP_CONCURRENCY
+    in flight (or the slots of a shared ``semaphore``), then the partial
+    summaries are reduced into one digest. Peak memory stays at a few
+    windows regardless of backlog size. Returns (summary, message_count).
+    """
+    semaphore = semaphore or asyncio.Semaphore(MAP_CONCURRENCY)
+    # Bounded so reading stops while the workers are busy
+    queue = asyncio.Queue(maxsize=MAP_CONCURRENCY)
+    partials = {}
+    message_count = 0
+
+    async def produce():
+        nonlocal message_count
+        index = 0
+        async for window in iter_unread_windows(client, dialog):
+            message_count += len(window)
+            await queue.put((index, window))
+            index += 1
+        for _ in range(MAP_CONCURRENCY):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, window = item
+            partials[index] = await _generate(_map_prompt(window, dialog.title, index), semaphore)
+            if message_handler.DEBUG:
+                print(f"Summarized part {index + 1} of '{dialog.title}'")
+
+    tasks = [asyncio.create_task(produce())]
+    tasks += [asyncio.create_task(work()) for _ in range(MAP_CONCURRENCY)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # A failed window fails the chat; stop reading and the other workers
+        for task in tasks:
+            task.cancel()
+        raise
+
+    ordered = [partials[index] for index in sorted(partials)]
+    if not dialog.read_inbox_max_id:
+        # Windows were read newest first
+        ordered.reverse()
+    summary = await reduce_summaries(ordered, dialog.title, semaphore)
+    return summary, message_count
@@ -0,0 +1,81 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import backfill
+import dialog_cache
+import message_handler
+import message_store
+from bench.fake_telegram import FakeTelegramClient
+
+CHAT_ID = 1000
+
+
+@pytest.fixture(params=["per-chat", "consolidated"])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(message_store, "DB_DIR", str(tmp_path))
+    monkeypatch.setattr(message_store, "STORAGE_BACKEND", request.param)
+    monkeypatch.setattr(message_handler, "SYNC_RATE", 10000.0)
+    dialog_cache.invalidate()
+    yield
+    dialog_cache.invalidate()
+    message_store.close_backend()
+
+
+def run(client, **kwargs):
+    return asyncio.run(backfill.backfill(client, [CHAT_ID], page_size=1000, **kwargs))
+
+
+def stored_ids():
+    with message_store.connection(CHAT_ID) as conn:
+        return {row[0] for row in conn.execute("SELECT telegram_id FROM messages WHERE chat_id = ?", (CHAT_ID,))}
+
+
+def test_resumes_after_interruption(store):
+    client = FakeTelegramClient(dialogs=1, messages=2500, unread=0)
+    iter_messages = client.iter_messages
+    calls = 0
+
+    def failing_second_page(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise ConnectionError("connection lost")
+        return iter_messages(*args, **kwargs)
+
+    client.iter_messages = failing_second_page
+    assert run(client)["failed"] == 1
+    assert message_store.get_backfill_state(CHAT_ID) == (1501, False)
+
+    client.iter_messages = iter_messages
+    totals = run(client)
+    assert totals["failed"] == 0
+    # Only the pages below the checkpoint were fetched again
+    assert totals["messages"] == 1500
+    assert stored_ids() == set(range(1, 2501))
+    assert message_store.get_backfill_state(CHAT_ID) == (1, True)
+
+
+def test_until_does_not_move_the_checkpoint_past_skipped_messages(store):
+    client = FakeTelegramClient(dialogs=1, messages=3000, unread=0)
+    # Message n is sent n minutes after client.started
+    run(client, since=client.started + timedelta(minutes=2500))
+    assert stored_ids() == set(range(2500, 3001))
+    run(client, until=client.started + timedelta(minutes=1000))
+    assert message_store.get_backfill_state(CHAT_ID) == (2500, False)
+
+    run(client)
+    assert stored_ids() == set(range(1, 3001))
+    assert message_store.get_backfill_state(CHAT_ID) == (1, True)
+
+
+def test_history_ending_on_a_page_boundary_is_done(store):
+    client = FakeTelegramClient(dialogs=1, messages=2000, unread=0)
+    totals = run(client)
+    assert totals["messages"] == 2000
+    assert message_store.get_backfill_state(CHAT_ID) == (1, True)
+
+    requests = client.requests
+    assert run(client)["messages"] == 0
+    assert client.requests == requests
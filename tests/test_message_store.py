@@ -0,0 +1,23 @@
+import pytest
+
+import message_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(message_store, "DB_DIR", str(tmp_path))
+    yield
+    message_store.close_backend()
+
+
+@pytest.mark.parametrize("backend", ["consolidated", "per-chat"])
+def test_new_database_uses_incremental_auto_vacuum(store, monkeypatch, backend):
+    monkeypatch.setattr(message_store, "STORAGE_BACKEND", backend)
+    with message_store.connection(1, write=True) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_consolidated_database_uses_wal(store, monkeypatch):
+    monkeypatch.setattr(message_store, "STORAGE_BACKEND", "consolidated")
+    with message_store.connection(None, write=True) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
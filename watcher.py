@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+from telethon import events
+
+import drafts
+import message_handler
+import message_store
+import senders
+from message_store import (
+    MessageWriter,
+    delete_messages,
+    delete_messages_outside_channels,
+    get_sync_info,
+    save_senders,
+    update_messages,
+    update_sync_info,
+)
+
+DEBUG = True
+
+# Queued events are written once this many are waiting or this many seconds
+# have passed since the last write
+WATCH_BATCH_SIZE = 200
+WATCH_FLUSH_INTERVAL = 2.0
+WATCH_QUEUE_SIZE = 10000
+
+class WatchStats:
+    """Counters for one watch session."""
+
+    def __init__(self):
+        self.new = 0
+        self.edited = 0
+        self.deleted = 0
+        self.flushes = 0
+        self.started = time.monotonic()
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started
+        return (f"{self.new} new, {self.edited} edited, {self.deleted} deleted "
+                f"in {self.flushes} writes over {elapsed:.0f}s")
+
+def _apply(batch, stats, held=()):
+    """Writes one batch of queued events, grouped by chat.
+
+    The sync position of chats in ``held`` is left where it is, so a later
+    fetch still requests the messages before these. Returns the chats that
+    received new messages.
+    """
+    by_chat = {}
+    received = []
+    for kind, chat_id, payload in batch:
+        by_chat.setdefault(chat_id, []).append((kind, payload))
+
+    for chat_id, chat_events in by_chat.items():
+        if chat_id is None:
+            # Deletions Telegram reported without a chat
+            ids = [telegram_id for _, ids in chat_events for telegram_id in ids]
+            removed = delete_messages_outside_channels(ids)
+            if removed is None and DEBUG:
+                print(f"Skipping {len(ids)} deletions without a chat on the {message_store.STORAGE_BACKEND} backend")
+            stats.deleted += removed or 0
+            continue
+
+        with MessageWriter(chat_id) as writer:
+            newest_telegram_id = 0
+            edits = []
+            sender_rows = []
+            for kind, payload in chat_events:
+                if kind == "new":
+                    writer.add(*payload)
+                    newest_telegram_id = max(newest_telegram_id, payload[0])
+                    stats.new += 1
+                elif kind == "edit":
+                    edits.append(payload)
+                    stats.edited += 1
+                elif kind == "sender":
+                    sender_rows.append(payload)
+                elif kind == "delete":
+                    # Deletions may refer to rows still waiting in the writer
+                    writer.flush()
+                    stats.deleted += delete_messages(chat_id, payload, conn=writer.conn)
+            writer.flush()
+
+            if edits:
+                update_messages(chat_id, edits, conn=writer.conn)
+            if sender_rows:
+                save_senders(chat_id, sender_rows, conn=writer.conn)
+
+            # Only ever move the sync position forward
+            if chat_id not in held and newest_telegram_id > get_sync_info(chat_id, conn=writer.conn):
+                update_sync_info(chat_id, newest_telegram_id, conn=writer.conn)
+            if newest_telegram_id:
+                received.append(chat_id)
+
+    stats.flushes += 1
+    return received
+
+async def _write_loop(queue, stats, held=()):
+    """Drains the event queue into the message store in batches."""
+    while True:
+        batch = [await queue.get()]
+        deadline = time.monotonic() + WATCH_FLUSH_INTERVAL
+        try:
+            while len(batch) < WATCH_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Runs on shutdown too, so events already taken off the queue
+            # are not lost
+            try:
+                drafts.schedule(_apply(batch, stats, held))
+            except Exception as e:
+                print(f"Failed to write {len(batch)} events: {e}")
+            for _ in batch:
+                queue.task_done()
+
+def _drain(queue, stats, held=None):
+    """Writes whatever is still queued, used on shutdown.
+
+    ``held`` None holds the sync position of every chat, for events
+    buffered before the catch-up pass finished.
+    """
+    batch = []
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+        queue.task_done()
+    if held is None:
+        held = {chat_id for _, chat_id, _ in batch}
+    if batch:
+        _apply(batch, stats, held)
+
+async def watch(client):
+    """Keeps the message store current from Telegram updates until disconnected.
+
+    Handlers are registered before the catch-up pass so nothing that
+    arrives meanwhile is missed, but their events are only buffered until
+    catch-up is done: writing them would move a chat's sync position past
+    the messages it missed while offline, and catch-up would then skip
+    them. Catch-up reuses fetch_messages, which only requests history for
+    chats whose top message moved while we were offline. Chats whose
+    catch-up failed keep their sync position for the next fetch.
+    """
+    queue = asyncio.Queue(maxsize=WATCH_QUEUE_SIZE)
+    stats = WatchStats()
+    # (chat, sender) pairs whose name was stored this session
+    named = set()
+
+    async def on_new(event):
+        message = event.message
+        if message.text:
+            await queue.put(("new", event.chat_id, (message.id, message.date, message.sender_id, message.text)))
+            # Updates carry the sender's entity, so names cost no request
+            entity = message.sender
+            if entity is not None and (event.chat_id, message.sender_id) not in named:
+                named.add((event.chat_id, message.sender_id))
+                await queue.put(("sender", event.chat_id, senders.sender_row(message.sender_id, entity)))
+
+    async def on_edit(event):
+        message = event.message
+        if message.text:
+            await queue.put(("edit", event.chat_id, (message.id, message.date, message.sender_id, message.text)))
+
+    async def on_delete(event):
+        await queue.put(("delete", event.chat_id, list(event.deleted_ids)))
+
+    handlers = [
+        (on_new, events.NewMessage()),
+        (on_edit, events.MessageEdited()),
+        (on_delete, events.MessageDeleted()),
+    ]
+    for callback, event in handlers:
+        client.add_event_handler(callback, event)
+
+    writer_task = None
+    held = None
+    try:
+        print("Catching up on chats that changed while offline...")
+        totals = await message_handler.fetch_messages(client)
+        held = set(totals["failed_chats"])
+        writer_task = asyncio.create_task(_write_loop(queue, stats, held))
+        drafts.schedule(totals["updated_chats"])
+
+        print("Watching for new messages. Press Ctrl+C to stop.")
+        await client.run_until_disconnected()
+    finally:
+        for callback, event in handlers:
+            client.remove_event_handler(callback, event)
+        if writer_task is not None:
+            writer_task.cancel()
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+        _drain(queue, stats, held)
+        await drafts.stop()
+        print(f"Watch stopped: {stats}")